@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""benchmark_compression.py
+
+Reports the size and the encode/decode throughput of metadata JSON written
+uncompressed and with each of the compression codecs (see encode_metadata_json),
+for metadata with a long history of ServiceExecution annotations (each with an
+embedded job specification).
+
+Usage:
+    python -m benchmarks.benchmark_compression
+"""
+
+import functools
+import timeit
+
+from data_manager_metadata.metadata import Metadata, ServiceExecutionAnnotation
+
+_ANNOTATION_COUNTS = [100, 1000]
+_REPEAT = 5
+
+
+def _job_spec(index: int) -> dict:
+    return {
+        'collection': 'im-virtual-screening',
+        'image': 'informaticsmatters/vs-nextflow:latest',
+        'type': 'NEXTFLOW',
+        'command': f'nextflow run /code/smina-docking.nf --ligands candidates-{index}.sdf',
+        'variables': {
+            'ligands': f'candidates-{index}.sdf',
+            'protein': 'dhfr-receptor-ph7.pdb',
+            'exhaustiveness': 8,
+        },
+        'outputs': {
+            f'output{output}': {
+                'title': f'Output {output}',
+                'mime-types': ['chemical/x-mdl-sdfile'],
+                'creates': f'results-{output}.sdf',
+                'type': 'file',
+            }
+            for output in range(10)
+        },
+    }
+
+
+def _metadata(count: int) -> Metadata:
+    metadata = Metadata('benchmark', '0000', '', 'bench')
+    for index in range(count):
+        metadata.add_annotation(
+            ServiceExecutionAnnotation(
+                'run-smina',
+                '1.0.0',
+                'user',
+                'run-smina',
+                'https://discourse.squonk.it/t/job-run-smina/78',
+                _job_spec(index),
+                'squonk2-job',
+                'Run smina docking',
+                {'affinity': {'type': 'number', 'description': 'Binding affinity'}},
+            )
+        )
+    return metadata
+
+
+def _time(function) -> float:
+    return min(timeit.repeat(function, number=1, repeat=_REPEAT))
+
+
+def main():
+    print('annotations codec   size (KB)   ratio   encode (MB/s)   decode (MB/s)')
+    for count in _ANNOTATION_COUNTS:
+        metadata = _metadata(count)
+        json_size = len(metadata.to_json().encode('utf8'))
+        for codec in [None, 'zlib', 'gzip']:
+            data = metadata.to_json(codec=codec)
+            size = len(data.encode('utf8')) if codec is None else len(data)
+            # Throughput is in MB of (uncompressed) JSON per second.
+            encode_time = _time(functools.partial(metadata.to_json, codec=codec))
+            decode_time = _time(
+                functools.partial(Metadata.from_json, data, trusted=True)
+            )
+            print(
+                f'{count:<11} {codec or "none":<7} {size / 1024:>9.0f}'
+                f' {json_size / size:>7.1f}'
+                f' {json_size / encode_time / 1e6:>15.1f}'
+                f' {json_size / decode_time / 1e6:>15.1f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+"""benchmark_job_annotations.py
+
+Compares the time taken to annotate a job output (with a parameter file) derived
+from metadata with a long history of annotations against a copy of the original
+code, where the derived metadata was read for every output and the results
+metadata was created (and validated) from dictionaries twice. Both use the
+current Metadata classes. The derived metadata is cached (for the process)
+between the repeated runs of create_job_annotations, as it is for the outputs of
+a job.
+
+Usage:
+    python -m benchmarks.benchmark_job_annotations
+"""
+
+import contextlib
+import copy
+import functools
+import io
+import json
+import os
+import tempfile
+import timeit
+
+from data_manager_metadata.data_tier_api import create_job_annotations, _write_file
+from data_manager_metadata.metadata import (
+    Metadata,
+    FieldsDescriptorAnnotation,
+    LabelAnnotation,
+    ServiceExecutionAnnotation,
+)
+
+_ANNOTATION_COUNTS = [100, 1000, 5000]
+_REPEAT = 20
+
+_JOB_APPLICATION_SPEC = {'variables': {'ligands': 'candidates.sdf'}}
+_JOB_RENDERED_SPEC = {
+    'job': 'run-smina',
+    'version': '1.0.0',
+    'outputs': {
+        'results': {
+            'creates': 'results.sdf',
+            'annotation-properties': {
+                'fields-descriptor': {
+                    'origin': 'squonk2-job',
+                    'description': 'Run smina docking',
+                    'fields': {
+                        'minimizedAffinity': {
+                            'type': 'number',
+                            'description': 'Binding affinity',
+                        }
+                    },
+                },
+                'labels': {'Protein': {'value': 'dhfr'}},
+                'derived-from': 'ligands',
+            },
+        }
+    },
+}
+
+
+def _write_derived_metadata(project_directory: str, count: int):
+    metadata = Metadata('ligands', '0000', '', 'bench')
+    for index in range(count):
+        metadata.add_annotation(
+            FieldsDescriptorAnnotation(
+                f'Supplier {index}',
+                'A description',
+                {f'field{index % 50}': {'type': 'number', 'description': 'Field'}},
+            )
+        )
+    _write_file(
+        os.path.join(project_directory, 'candidates.meta.json'),
+        metadata.to_json().encode('utf8'),
+    )
+
+
+def _original_create_annotations(project_directory: str):
+    """create_job_annotations (for the benchmark's output) as it was before it was
+    changed, copied from the original data_tier_api. The derived metadata is read
+    for every output and the results metadata is created (and validated) from
+    dictionaries twice: to add the annotations and to write the parameter file.
+    """
+    output_spec = _JOB_RENDERED_SPEC['outputs']['results']
+    annotation_properties = output_spec['annotation-properties']
+    job_rendered_spec = copy.deepcopy(_JOB_RENDERED_SPEC)
+    job_rendered_spec['variables'] = _JOB_APPLICATION_SPEC.get('variables')
+
+    # _get_derived_metadata
+    meta_path = os.path.join(project_directory, 'candidates.meta.json')
+    print(meta_path)
+    with open(meta_path, 'rt', encoding='utf8') as meta_file:
+        derived_metadata = json.load(meta_file)
+
+    # _create_labels
+    new_labels = []
+    for label, values in annotation_properties['labels'].items():
+        new_label = LabelAnnotation(
+            label,
+            value=values.get('value'),
+            active=values.get('active', True),
+            reference=values.get('reference'),
+        )
+        new_labels.append(new_label.to_dict())
+
+    # _create_service_execution
+    fields_descriptor = annotation_properties['fields-descriptor']
+    job = job_rendered_spec.pop('job')
+    version = job_rendered_spec.pop('version')
+    for values in job_rendered_spec['outputs'].values():
+        values.pop('annotation-properties', None)
+    se_annotation = ServiceExecutionAnnotation(
+        job,
+        version,
+        'bench',
+        job,
+        'Not supplied',
+        job_rendered_spec,
+        fields_descriptor['origin'],
+        fields_descriptor['description'],
+        fields_descriptor['fields'],
+    ).to_dict()
+
+    # patch_travelling_metadata
+    metadata = Metadata(**derived_metadata)
+    metadata.add_labels(new_labels)
+    metadata.add_annotations(se_annotation)
+    results_metadata, results_schema = metadata.to_dict(), metadata.get_json_schema()
+
+    with open(
+        os.path.join(project_directory, 'results.meta.json'), 'wt', encoding='utf8'
+    ) as meta_file:
+        json.dump(results_metadata, meta_file)
+    with open(
+        os.path.join(project_directory, 'results.schema.json'), 'wt', encoding='utf8'
+    ) as schema_file:
+        json.dump(results_schema, schema_file)
+
+    # _create_param_file
+    metadata = Metadata(**results_metadata)
+    result_params = {
+        key: values['description']
+        for key, values in metadata.get_compiled_fields()['fields'].items()
+    }
+    with open(
+        os.path.join(project_directory, 'results.params.json'), 'wt', encoding='utf8'
+    ) as params_file:
+        json.dump(result_params, params_file)
+
+
+def _time(function) -> float:
+    return min(timeit.repeat(function, number=1, repeat=_REPEAT)) * 1000
+
+
+def _read_outputs(project_directory: str) -> tuple:
+    outputs = []
+    for filename in ['results.schema.json', 'results.params.json']:
+        with open(
+            os.path.join(project_directory, filename), 'rt', encoding='utf8'
+        ) as output_file:
+            outputs.append(json.load(output_file))
+    return tuple(outputs)
+
+
+def main():
+    print('annotations   original (ms)   live metadata (ms)')
+    for count in _ANNOTATION_COUNTS:
+        with tempfile.TemporaryDirectory() as project_directory:
+            _write_derived_metadata(project_directory, count)
+
+            original = functools.partial(
+                _original_create_annotations, project_directory
+            )
+            live_metadata = functools.partial(
+                create_job_annotations,
+                project_directory,
+                _JOB_APPLICATION_SPEC,
+                _JOB_RENDERED_SPEC,
+                'bench',
+                True,
+            )
+
+            # Both print the path of the derived metadata
+            with contextlib.redirect_stdout(io.StringIO()):
+                original()
+                original_outputs = _read_outputs(project_directory)
+                live_metadata()
+                assert _read_outputs(project_directory) == original_outputs
+                original_time = _time(original)
+                live_metadata_time = _time(live_metadata)
+
+            print(f'{count:<13} {original_time:>13.2f} {live_metadata_time:>20.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""benchmark_labels.py
+
+Compares the time taken to select the labels used when synchronising travelling
+metadata with a dataset using the label indexes in Metadata against a linear scan
+of the label history (the approach used before the indexes were added).
+
+Usage:
+    python -m benchmarks.benchmark_labels
+"""
+
+import datetime
+import functools
+import timeit
+
+from data_manager_metadata.metadata import Metadata
+
+_LABEL_COUNTS = [10000, 50000]
+_REPEAT = 5
+
+
+def _label_rows(count: int) -> list:
+    """Create a label history where each of 500 labels has been patched
+    repeatedly, one label every second.
+    """
+    start = datetime.datetime(2022, 1, 1)
+    prefixes = ['', '#', '@']
+    return [
+        {
+            'type': 'LabelAnnotation',
+            'label': f'{prefixes[index % 3]}label{index % 500}',
+            'value': f'value{index}',
+            'active': index % 7 != 0,
+            'created': (
+                start + datetime.timedelta(seconds=index, microseconds=1)
+            ).isoformat(),
+        }
+        for index in range(count)
+    ]
+
+
+def _linear_existing_dataset(metadata: Metadata, synchronised_datetime: str):
+    compare_datetime = datetime.datetime.strptime(
+        synchronised_datetime, '%Y-%m-%dT%H:%M:%S.%f'
+    )
+    return [
+        label.to_dict()
+        for label in metadata.labels
+        if datetime.datetime.fromisoformat(label.get_created()) > compare_datetime
+    ]
+
+
+def _linear_new_dataset(metadata: Metadata, synchronised_datetime: str):
+    label_list = []
+    label_set = set()
+    for anno in reversed(metadata.labels):
+        if anno.get_label() not in label_set:
+            label_list.append(anno)
+            label_set.add(anno.get_label())
+    for label in reversed(label_list):
+        if label.get_active() is False:
+            label_list.remove(label)
+    active_labels = [label.to_dict() for label in label_list]
+    return [
+        label
+        for label in active_labels
+        if label['label'][0] in ['#', '@'] or label['created'] >= synchronised_datetime
+    ]
+
+
+def _time(function) -> float:
+    return min(timeit.repeat(function, number=1, repeat=_REPEAT)) * 1000
+
+
+def main():
+    print('labels   query              linear (ms)   indexed (ms)')
+    for count in _LABEL_COUNTS:
+        metadata = Metadata('benchmark', '0000', '', 'bench', labels=_label_rows(count))
+        # Synchronise 100 labels before the end of the history.
+        sync_time = (
+            datetime.datetime(2022, 1, 1) + datetime.timedelta(seconds=count - 100)
+        ).strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+        for name, linear, indexed in [
+            (
+                'existing_dataset',
+                functools.partial(_linear_existing_dataset, metadata, sync_time),
+                functools.partial(metadata.get_labels_existing_dataset, sync_time),
+            ),
+            (
+                'new_dataset',
+                functools.partial(_linear_new_dataset, metadata, sync_time),
+                functools.partial(metadata.get_labels_new_dataset, sync_time),
+            ),
+        ]:
+            assert len(linear()) == len(indexed())
+            print(
+                f'{count:<8} {name:<18} {_time(linear):>11.2f} {_time(indexed):>14.2f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+"""benchmark_memory.py
+
+Reports the memory used (bytes per annotation) by each type of annotation
+when metadata for many datasets is held in memory, before and after the
+annotations were changed to use slots. The annotations before are copies of how
+the original classes held their items: in a per-instance __dict__, with a
+datetime created time and each field as a copy of FIELD_DICT. The memory is
+measured with tracemalloc, so it includes the annotation's fields and service
+parameters.
+
+Usage:
+    python -m benchmarks.benchmark_memory
+"""
+
+import copy
+import datetime
+import functools
+import gc
+import tracemalloc
+
+from data_manager_metadata.metadata import (
+    FIELD_DICT,
+    get_annotation_version,
+    PropertyChangeAnnotation,
+    LabelAnnotation,
+    FieldsDescriptorAnnotation,
+    ServiceExecutionAnnotation,
+)
+
+_COUNT = 5000
+
+_FIELDS = {
+    f'field{index}': {
+        'type': 'number',
+        'description': f'Field {index} description',
+        'required': index % 2 == 0,
+        'active': True,
+    }
+    for index in range(10)
+}
+
+
+class _DictAnnotation:
+    """The items of the original Annotation (without the methods)."""
+
+    def __init__(self):
+        self.created = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        self.annotation_version = get_annotation_version()
+
+
+class _DictPropertyChangeAnnotation(_DictAnnotation):
+    def __init__(self, meta_property: str, previous_value: str):
+        self.meta_property = meta_property
+        self.previous_value = previous_value
+        super().__init__()
+
+
+class _DictLabelAnnotation(_DictAnnotation):
+    def __init__(self, label: str, value: str = None):
+        self.label = label.lower()
+        self.value = value
+        self.active = True
+        self.reference = None
+        super().__init__()
+
+
+class _DictFieldsDescriptorAnnotation(_DictAnnotation):
+    def __init__(
+        self, origin: str, description: str, fields: dict, job_spec: dict = None
+    ):
+        self.origin = origin
+        self.description = description
+        self.spec = job_spec
+        self.fields = {}
+        for prop, values in fields.items():
+            # As add_field, each field is a copy of FIELD_DICT
+            self.fields[prop] = copy.deepcopy(FIELD_DICT)
+            self.fields[prop]['active'] = values.get('active', True)
+            self.fields[prop]['type'] = values['type'].lower()
+            if values.get('description'):
+                self.fields[prop]['description'] = values['description']
+            if values.get('required'):
+                self.fields[prop]['required'] = values['required']
+        super().__init__()
+
+
+class _DictServiceExecutionAnnotation(_DictFieldsDescriptorAnnotation):
+    def __init__(
+        self,
+        service: str,
+        service_version: str,
+        service_user: str,
+        service_name: str,
+        service_ref: str,
+        service_parameters: dict,
+        origin: str,
+        description: str,
+        fields: dict,
+    ):
+        self.service = service
+        self.service_version = service_version
+        self.service_user = service_user
+        self.service_name = service_name
+        self.service_ref = service_ref
+        self.service_parameters = copy.deepcopy(service_parameters)
+        super().__init__(origin, description, fields, service_parameters)
+
+
+def _property_change(index: int, annotation_class=PropertyChangeAnnotation):
+    return annotation_class('description', f'Description {index}')
+
+
+def _label(index: int, annotation_class=LabelAnnotation):
+    return annotation_class(f'label{index % 100}', f'value{index}')
+
+
+def _fields_descriptor(index: int, annotation_class=FieldsDescriptorAnnotation):
+    return annotation_class(f'Supplier {index}', 'A description', _FIELDS)
+
+
+def _service_execution(index: int, annotation_class=ServiceExecutionAnnotation):
+    return annotation_class(
+        'run-smina',
+        '1.0.0',
+        'user',
+        'run-smina',
+        'https://discourse.squonk.it/t/job-run-smina/78',
+        {'image': 'informaticsmatters/vs-nextflow:latest', 'run': index},
+        'squonk2-job',
+        'Run smina docking',
+        _FIELDS,
+    )
+
+
+def _bytes_per_annotation(factory) -> float:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    annotations = [factory(index) for index in range(_COUNT)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    assert len(annotations) == _COUNT
+    return allocated / _COUNT
+
+
+def main():
+    print('annotation                    before (bytes)   after (bytes)')
+    for name, factory, dict_annotation_class in [
+        ('PropertyChangeAnnotation', _property_change, _DictPropertyChangeAnnotation),
+        ('LabelAnnotation', _label, _DictLabelAnnotation),
+        (
+            'FieldsDescriptorAnnotation',
+            _fields_descriptor,
+            _DictFieldsDescriptorAnnotation,
+        ),
+        (
+            'ServiceExecutionAnnotation',
+            _service_execution,
+            _DictServiceExecutionAnnotation,
+        ),
+    ]:
+        before = _bytes_per_annotation(
+            functools.partial(factory, annotation_class=dict_annotation_class)
+        )
+        after = _bytes_per_annotation(factory)
+        print(f'{name:<29} {before:>14.0f} {after:>15.0f}')
+
+
+if __name__ == '__main__':
+    main()
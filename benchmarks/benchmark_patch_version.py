@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""benchmark_patch_version.py
+
+Compares the time taken by patch_version_metadata for versions with large
+annotation histories against a copy of the original code, where the dataset and
+version metadata were created (and validated) from their dictionaries and the
+version metadata was serialised and loaded again (as a third Metadata object)
+just to add the dataset labels for the json schema. Both use the current
+Metadata classes.
+
+Usage:
+    python -m benchmarks.benchmark_patch_version
+"""
+
+import functools
+import timeit
+
+from data_manager_metadata.data_tier_api import patch_version_metadata
+from data_manager_metadata.metadata import (
+    Metadata,
+    FieldsDescriptorAnnotation,
+    LabelAnnotation,
+)
+
+_ANNOTATION_COUNTS = [100, 1000, 5000]
+_LABEL_COUNT = 200
+_REPEAT = 5
+
+
+def _fields(index: int) -> dict:
+    return {
+        f'field{field}': {
+            'type': 'number',
+            'description': f'Field {field} description {index}',
+            'required': field % 2 == 0,
+            'active': True,
+        }
+        for field in range(20)
+    }
+
+
+def _dataset_metadata() -> dict:
+    metadata = Metadata('benchmark', '0000', '', 'bench')
+    for index in range(_LABEL_COUNT):
+        metadata.add_label(LabelAnnotation(f'label{index % 50}', f'value{index}'))
+    return metadata.to_dict()
+
+
+def _version_metadata(count: int) -> dict:
+    metadata = Metadata('benchmark', '0000', '', 'bench', dataset_version=1)
+    for index in range(count):
+        metadata.add_annotation(
+            FieldsDescriptorAnnotation(
+                f'Supplier {index}', 'A description', _fields(index)
+            )
+        )
+    return metadata.to_dict()
+
+
+def _three_parse_patch_version_metadata(
+    dataset_metadata: dict, version_metadata: dict, **metadata_params
+):
+    """patch_version_metadata as it was before it was changed (from the original
+    data_tier_api), where all three Metadata objects are created (and validated)
+    from the dictionaries.
+    """
+    d_metadata = Metadata(**dataset_metadata)
+    v_metadata = Metadata(**version_metadata)
+
+    if 'description' in metadata_params:
+        v_metadata.set_description(metadata_params['description'])
+
+    if 'annotations' in metadata_params:
+        v_metadata.add_annotations(metadata_params['annotations'])
+
+    # This adds the dataset labels to the version metadata so
+    # we can extract the json schema with both labels and annotations.
+    schema_metadata = Metadata(**v_metadata.to_dict())
+    schema_metadata.add_labels(d_metadata.get_labels())
+
+    return v_metadata.to_dict(), schema_metadata.get_json_schema()
+
+
+def _time(function) -> float:
+    return min(timeit.repeat(function, number=1, repeat=_REPEAT)) * 1000
+
+
+def main():
+    print('annotations   three parses (ms)   single parse (ms)')
+    dataset_metadata = _dataset_metadata()
+    new_annotation = FieldsDescriptorAnnotation(
+        'Supplier', 'A new description', _fields(-1)
+    ).to_dict()
+    for count in _ANNOTATION_COUNTS:
+        version_metadata = _version_metadata(count)
+
+        three_parses = functools.partial(
+            _three_parse_patch_version_metadata,
+            dataset_metadata,
+            version_metadata,
+            annotations=new_annotation,
+        )
+        single_parse = functools.partial(
+            patch_version_metadata,
+            dataset_metadata,
+            version_metadata,
+            annotations=new_annotation,
+        )
+
+        assert three_parses()[1] == single_parse()[1]
+        print(f'{count:<13} {_time(three_parses):>17.2f} {_time(single_parse):>19.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,11 @@ Version metadata is the metadata that is stored at the dataset version level in
 manager. This does not have labels but has the other types of annotations such as
 ServiceExecution and FieldsDescriptor
 
+Dataset and version metadata passed to these methods has been read back from the
+database. It was validated when it was written so it is loaded in "trusted" mode
+(see Metadata.from_dict). Anything newly supplied by the caller (labels, annotations
+and travelling metadata) is always validated.
+
 Travelling metadata is a combination of dataset and version metadata that is typically
 downloaded to a project as a meta.json file, added to after a job and then re-uploaded back
 as a dataset.
@@ -20,21 +25,42 @@ The job related annotations that are added to the metadata depend on the configu
 and specification of the job.
 """
 
-from typing import Any, Dict, Tuple, Optional
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple, Optional
+import asyncio
 import copy
+import functools
+import hashlib
 import os
 import json
 import logging
+import stat
+import threading
+import uuid
 
 from data_manager_metadata.metadata import (
     Metadata,
     ServiceExecutionAnnotation,
     LabelAnnotation,
+    get_field_expression,
+    decode_metadata_json,
+    get_canonical_json,
+    get_content_hash,
+    get_labels_fingerprint,
 )
 from data_manager_metadata.exceptions import AnnotationValidationError
 
 basic_logger: logging.Logger = logging.getLogger(__name__)
 
+# The number of annotation plans (see _get_annotation_plan) that are cached.
+_ANNOTATION_PLAN_CACHE_SIZE: int = 256
+
+# The limits of the derived metadata cache (see _DerivedMetadataCache),
+# in files and in (uncompressed) JSON characters.
+_DERIVED_METADATA_CACHE_FILES: int = 128
+_DERIVED_METADATA_CACHE_CHARACTERS: int = 64 * 1024 * 1024
+
 
 def get_metadata_filenames(filepath: str) -> Tuple[str, str]:
     """Return the associated metadata and schema filenames for a particular
@@ -52,6 +78,21 @@ def get_metadata_filenames(filepath: str) -> Tuple[str, str]:
     return filename_stem + _METADATA_EXT, filename_stem + _SCHEMA_EXT
 
 
+def get_metadata_etag(metadata: Dict[str, Any]) -> str:
+    """Return an ETag for metadata (dataset, version or travelling). This only
+    changes when the content of the metadata changes, so it can be used to avoid
+    writing unchanged metadata.
+    """
+    return Metadata.from_dict(metadata, trusted=True).get_content_hash()
+
+
+def get_schema_etag(json_schema: Dict[str, Any]) -> str:
+    """Return an ETag for a json schema. This only changes when the content of
+    the schema changes.
+    """
+    return get_content_hash(json_schema)
+
+
 # Dataset Methods
 def post_dataset_metadata(
     dataset_name: str,
@@ -118,8 +159,10 @@ def post_version_metadata(
         **metadata_params,
     )
 
-    return version_metadata.to_dict(), get_version_schema(
-        dataset_metadata, version_metadata.to_dict()
+    # The version schema includes the dataset labels.
+    d_metadata = Metadata.from_dict(dataset_metadata, trusted=True)
+    return version_metadata.to_dict(), version_metadata.get_json_schema(
+        inherited_labels=d_metadata.get_label_annotations()
     )
 
 
@@ -143,7 +186,7 @@ def patch_dataset_metadata(
         json_schema
     """
 
-    metadata = Metadata(**dataset_metadata)
+    metadata = Metadata.from_dict(dataset_metadata, trusted=True)
 
     if 'description' in metadata_params:
         metadata.set_description(metadata_params['description'])
@@ -169,11 +212,93 @@ def get_version_schema(
     Returns:
         json_schema
     """
-    d_metadata = Metadata(**dataset_metadata)
-    v_metadata = Metadata(**version_metadata)
-    v_metadata.add_labels(d_metadata.get_labels())
+    d_metadata = Metadata.from_dict(dataset_metadata, trusted=True)
+    return _get_inherited_version_schema(
+        d_metadata.get_label_annotations(), version_metadata
+    )
+
 
-    return v_metadata.get_json_schema()
+def get_version_schemas(
+    dataset_metadata: Dict[str, Any],
+    versions_metadata: List[Dict[str, Any]],
+    max_workers: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """Get the current json schema for each of a list of versions of a dataset.
+
+    This is equivalent to calling get_version_schema for each version (e.g. after
+    a patch_dataset_metadata call) but the dataset metadata is only loaded once.
+
+    Args:
+        dataset_metadata
+        versions_metadata: list of version metadata
+        max_workers (optional): if set (to more than 1) the schemas are calculated
+            in a pool of (up to) this many processes. This is only worthwhile
+            for datasets with many versions.
+
+    Returns:
+        list of json_schema (in the order of versions_metadata)
+    """
+    d_metadata = Metadata.from_dict(dataset_metadata, trusted=True)
+    get_schema = functools.partial(
+        _get_inherited_version_schema, d_metadata.get_label_annotations()
+    )
+
+    if not max_workers or max_workers <= 1 or len(versions_metadata) <= 1:
+        return [get_schema(version_metadata) for version_metadata in versions_metadata]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # Send the versions to the workers in chunks (of about 4 per worker)
+        # to reduce the overhead of sending the dataset labels.
+        chunksize = max(1, len(versions_metadata) // (max_workers * 4))
+        return list(executor.map(get_schema, versions_metadata, chunksize=chunksize))
+
+
+def _get_inherited_version_schema(
+    dataset_labels: List[LabelAnnotation], version_metadata: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Return the json schema of the version with the dataset labels (the latest
+    labels returned by get_label_annotations) inherited from the dataset level.
+    """
+    v_metadata = Metadata.from_dict(version_metadata, trusted=True)
+    return v_metadata.get_json_schema(inherited_labels=dataset_labels)
+
+
+def refresh_version_schema_labels(
+    version_schema: Dict[str, Any],
+    dataset_labels: Dict[str, Any],
+    labels_fingerprint: Optional[str] = None,
+) -> Tuple[Dict[str, Any], str]:
+    """Update the labels of a version json schema after the dataset labels have
+    changed (i.e. after a patch_dataset_metadata call).
+
+    This is a faster alternative to get_version_schema when only the dataset labels
+    have changed, as version metadata has no labels of its own. Only the labels
+    section of the schema is replaced. If the set of labels is unchanged the
+    schema is returned as it is.
+
+    Args:
+        version_schema: the current json schema of the version
+        dataset_labels: the active dataset labels, i.e. the labels of the dataset
+            json schema returned by patch_dataset_metadata
+        labels_fingerprint (optional): the fingerprint returned when the version
+            schema was last refreshed. If not given, it is calculated from the
+            version schema.
+
+    Returns:
+        json_schema
+        labels fingerprint (of dataset_labels)
+    """
+    fingerprint = get_labels_fingerprint(dataset_labels)
+    if labels_fingerprint is None:
+        labels_fingerprint = get_labels_fingerprint(version_schema['labels'])
+    if fingerprint == labels_fingerprint:
+        return version_schema, fingerprint
+
+    # The dataset schema has the most recently applied labels first whereas the
+    # version schema (see get_version_schema) has them the other way round.
+    schema = dict(version_schema)
+    schema['labels'] = dict(reversed(dataset_labels.items()))
+    return schema, fingerprint
 
 
 def patch_version_metadata(
@@ -193,8 +318,8 @@ def patch_version_metadata(
         metadata dict
         json_schema
     """
-    d_metadata = Metadata(**dataset_metadata)
-    v_metadata = Metadata(**version_metadata)
+    d_metadata = Metadata.from_dict(dataset_metadata, trusted=True)
+    v_metadata = Metadata.from_dict(version_metadata, trusted=True)
 
     if 'description' in metadata_params:
         v_metadata.set_description(metadata_params['description'])
@@ -202,12 +327,11 @@ def patch_version_metadata(
     if 'annotations' in metadata_params:
         v_metadata.add_annotations(metadata_params['annotations'])
 
-    # This adds the dataset labels to the version metadata so
-    # we can extract the json schema with both labels and annotations.
-    schema_metadata = Metadata(**v_metadata.to_dict())
-    schema_metadata.add_labels(d_metadata.get_labels())
-
-    return v_metadata.to_dict(), schema_metadata.get_json_schema()
+    # The json schema has both the version's (compiled) fields and the
+    # dataset labels.
+    return v_metadata.to_dict(), v_metadata.get_json_schema(
+        inherited_labels=d_metadata.get_label_annotations()
+    )
 
 
 # Travelling Metadata Methods
@@ -230,9 +354,9 @@ def get_travelling_metadata(
         travelling json_schema
     """
 
-    d_metadata = Metadata(**dataset_metadata)
-    v_metadata = Metadata(**version_metadata)
-    d_metadata.add_annotations(v_metadata.get_annotations_dict())
+    d_metadata = Metadata.from_dict(dataset_metadata, trusted=True)
+    v_metadata = Metadata.from_dict(version_metadata, trusted=True)
+    d_metadata.merge_annotations(v_metadata)
     d_metadata.set_synchronised_datetime()
     d_metadata.set_dataset_version(v_metadata.get_dataset_version())
     return d_metadata.to_dict(), d_metadata.get_json_schema()
@@ -257,18 +381,16 @@ def post_travelling_metadata_to_new_dataset(
         version json schema
     """
 
-    t_metadata = Metadata(**travelling_metadata)
+    # Only the labels are used from the travelling metadata object. The annotations
+    # are validated (and copied) once, when the version metadata is created.
+    t_metadata = Metadata(**dict(travelling_metadata, annotations=None))
     synchronised_datetime = t_metadata.get_synchronised_datetime()
 
     d_metadata_params = {
-        'labels': copy.deepcopy(
-            t_metadata.get_labels_new_dataset(synchronised_datetime)
-        )
+        'labels': t_metadata.get_labels_new_dataset(synchronised_datetime)
     }
 
-    v_metadata_params = {
-        'annotations': copy.deepcopy(travelling_metadata['annotations'])
-    }
+    v_metadata_params = {'annotations': travelling_metadata['annotations']}
 
     dataset_metadata, dataset_schema = post_dataset_metadata(
         travelling_metadata['dataset_name'],
@@ -334,17 +456,15 @@ def post_travelling_metadata_to_existing_dataset(
         version json schema
     """
 
-    t_metadata = Metadata(**travelling_metadata)
+    # Only the labels are used from the travelling metadata object. The annotations
+    # are validated (and copied) once, when the version metadata is created.
+    t_metadata = Metadata(**dict(travelling_metadata, annotations=None))
     synchronised_datetime = t_metadata.get_synchronised_datetime()
 
     d_metadata_params = {
-        'labels': copy.deepcopy(
-            t_metadata.get_labels_existing_dataset(synchronised_datetime)
-        )
-    }
-    v_metadata_params = {
-        'annotations': copy.deepcopy(travelling_metadata['annotations'])
+        'labels': t_metadata.get_labels_existing_dataset(synchronised_datetime)
     }
+    v_metadata_params = {'annotations': travelling_metadata['annotations']}
 
     dataset_metadata, dataset_schema = patch_dataset_metadata(
         dataset_metadata, **d_metadata_params
@@ -358,10 +478,111 @@ def post_travelling_metadata_to_existing_dataset(
 
 
 # Job Annotation Methods
+class _DerivedMetadataCache:
+    """A process-wide cache of the (parsed) meta.json files that job outputs are
+    derived from, so that a file used by many outputs (or jobs) is read once.
+
+    Entries are indexed by path and are only used while the file's modification
+    time and size (and inode, as files are replaced when written) are
+    unchanged. The least recently used entries are evicted when there are more
+    than max_files, or more than max_characters of JSON, cached.
+
+    The cached metadata is shared, so it must not be changed by its users.
+    """
+
+    def __init__(self, max_files: int, max_characters: int):
+        self.max_files = max_files
+        self.max_characters = max_characters
+        # (modification time, size, inode, characters, metadata) indexed by path
+        self._entries: OrderedDict = OrderedDict()
+        self._characters = 0
+        self._lock = threading.Lock()
+        self.reads = 0
+        self.reads_avoided = 0
+        self.evictions = 0
+
+    def get(self, meta_path: str) -> Optional[Dict[str, Any]]:
+        """Return the metadata in meta_path, or None if there is no such file."""
+        try:
+            meta_stat = os.stat(meta_path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(meta_stat.st_mode):
+            return None
+        signature = (meta_stat.st_mtime_ns, meta_stat.st_size, meta_stat.st_ino)
+
+        with self._lock:
+            entry = self._entries.get(meta_path)
+            if entry and entry[:3] == signature:
+                self._entries.move_to_end(meta_path)
+                self.reads_avoided += 1
+                return entry[4]
+
+        # The file may have been compressed (see create_job_annotations).
+        with open(meta_path, 'rb') as meta_file:
+            metadata_json = decode_metadata_json(meta_file.read())
+        metadata = json.loads(metadata_json)
+
+        with self._lock:
+            self.reads += 1
+            self._remove(meta_path)
+            if len(metadata_json) <= self.max_characters:
+                self._entries[meta_path] = signature + (len(metadata_json), metadata)
+                self._characters += len(metadata_json)
+            while (
+                len(self._entries) > self.max_files
+                or self._characters > self.max_characters
+            ):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return metadata
+
+    def _remove(self, meta_path: str):
+        entry = self._entries.pop(meta_path, None)
+        if entry:
+            self._characters -= entry[3]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._characters = 0
+
+    def get_metrics(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'files': len(self._entries),
+                'characters': self._characters,
+                'reads': self.reads,
+                'reads_avoided': self.reads_avoided,
+                'evictions': self.evictions,
+            }
+
+
+_DERIVED_METADATA_CACHE = _DerivedMetadataCache(
+    _DERIVED_METADATA_CACHE_FILES, _DERIVED_METADATA_CACHE_CHARACTERS
+)
+
+
+def get_derived_metadata_cache_metrics() -> Dict[str, int]:
+    """Return the metrics of the cache of the meta.json files that job outputs
+    are derived from: the number of files and (JSON) characters cached, the
+    files read, the reads avoided (by using the cache) and the evictions.
+    """
+    return _DERIVED_METADATA_CACHE.get_metrics()
+
+
+def clear_derived_metadata_cache():
+    """Empty the cache of the meta.json files that job outputs are derived from."""
+    _DERIVED_METADATA_CACHE.clear()
+
+
 def _get_derived_metadata(
     project_directory: str, username: str, source_file: str = '', derived_from: str = ''
 ) -> Dict[str, Any]:
-    """Return or create metadata for derived_from file."""
+    """Return or create metadata for derived_from file.
+    Metadata read from a file is cached (see _DerivedMetadataCache) and must not
+    be changed.
+    """
 
     if isinstance(source_file, str):
         # If the source_file is a string then check for it. We don't allow multiple input files
@@ -371,9 +592,9 @@ def _get_derived_metadata(
         meta_path = os.path.join(project_directory, meta_dir, meta_file)
         print(meta_path)
 
-        if os.path.isfile(meta_path):
-            with open(meta_path, 'rt', encoding='utf8') as meta_file:
-                return json.load(meta_file)
+        metadata = _DERIVED_METADATA_CACHE.get(meta_path)
+        if metadata is not None:
+            return metadata
 
     # Create the dictionary with the remaining parameters
     metadata = Metadata(derived_from, 'None', 'Automatically created by job', username)
@@ -382,7 +603,72 @@ def _get_derived_metadata(
     return metadata.to_dict()
 
 
-def _create_labels(output_spec: Dict[str, Any]) -> list:
+class _AnnotationPlan:
+    """The annotations for an output of a job definition (its annotation-properties)
+    prepared once, so that each job instance only has to bind its variables.
+
+    The labels are validated (only their created time is set when they are bound),
+    the field expressions are compiled and the service_ref is resolved.
+    """
+
+    __slots__ = ('labels', 'fields_descriptor', 'fields', 'service_ref')
+
+    def __init__(self, annotation_properties: Dict[str, Any]):
+        self.labels = []
+        label_spec = annotation_properties.get('labels') or {}
+        for label, values in label_spec.items():
+            value = values['value'] if 'value' in values else None
+            active = values['active'] if 'active' in values else True
+            reference = values['reference'] if 'reference' in values else None
+            label_row = LabelAnnotation(
+                label, value=value, active=active, reference=reference
+            ).to_dict()
+            label_row.pop('created')
+            self.labels.append(label_row)
+
+        self.fields_descriptor = annotation_properties['fields-descriptor']
+        self.fields = {
+            field_name: (
+                dict(values, expression=get_field_expression(values['expression']))
+                if isinstance(values, dict) and values.get('expression')
+                else values
+            )
+            for field_name, values in (
+                self.fields_descriptor.get('fields') or {}
+            ).items()
+        }
+
+        # Following a discussion on 04/05/2022 I've made this optional.
+        service_execution = annotation_properties.get('service-execution', {})
+        self.service_ref = service_execution.get('service_ref', 'Not supplied')
+
+
+@functools.lru_cache(maxsize=_ANNOTATION_PLAN_CACHE_SIZE)
+def _get_cached_annotation_plan(
+    job: str, version: str, annotation_properties_json: str
+) -> _AnnotationPlan:
+    """Return the annotation plan for the (canonical JSON of the)
+    annotation-properties of an output of a job definition.
+    """
+    del job, version  # Only used to identify the job definition in the cache
+    return _AnnotationPlan(json.loads(annotation_properties_json))
+
+
+def _get_annotation_plan(
+    job_rendered_spec: Dict[str, Any], output_spec: Dict[str, Any]
+) -> _AnnotationPlan:
+    """Return the annotation plan for an output of a job. The definition of a job
+    (version) does not change, so plans are cached by the job, version and
+    annotation-properties.
+    """
+    return _get_cached_annotation_plan(
+        job_rendered_spec.get('job'),
+        job_rendered_spec.get('version'),
+        get_canonical_json(output_spec['annotation-properties']),
+    )
+
+
+def _create_labels(plan: _AnnotationPlan) -> List[LabelAnnotation]:
     """Creates a service execution annotation based on the input specification
     Initially this will be coded according to SC-2623 but without the #labels from
     other input files.
@@ -399,8 +685,6 @@ def _create_labels(output_spec: Dict[str, Any]) -> list:
     Returns:
          The new label annotations to add to the metadata
     """
-    label_spec = output_spec["annotation-properties"].get('labels')
-
     new_labels = []
     # For 2)
     # - look for metadata files for each input file.
@@ -408,22 +692,46 @@ def _create_labels(output_spec: Dict[str, Any]) -> list:
     # - Add these to the list.
 
     # For 3)
-    # - look for the list of label in the annotation properties and add.
-    for label, values in label_spec.items():
-        value = values['value'] if 'value' in values else None
-        active = values['active'] if 'active' in values else True
-        reference = values['reference'] if 'reference' in values else None
-        new_label = LabelAnnotation(
-            label, value=value, active=active, reference=reference
-        )
-        new_labels.append(new_label.to_dict())
+    # - add the labels in the annotation properties (validated in the plan)
+    #   as new labels.
+    for label_row in plan.labels:
+        new_labels.append(LabelAnnotation.from_dict(label_row))
 
     return new_labels
 
 
-def _create_service_execution(
-    job_rendered_spec: Dict[str, Any], username: str, output_spec: Dict[str, Any]
+def _get_service_parameters(
+    job_application_spec: Dict[str, Any], job_rendered_spec: Dict[str, Any]
 ) -> Dict[str, Any]:
+    """Returns the service parameters of a job's service execution annotations,
+    prepared (once) from a copy of the rendered specification. The service
+    parameters are shared by all of the job's outputs and are not modified.
+    """
+
+    # Take service parameters from rendered specification and modify.
+    service_parameters: Dict[str, Any] = copy.deepcopy(job_rendered_spec)
+
+    # Add any variables from the application spec
+    service_parameters['variables'] = job_application_spec.get('variables')
+
+    # Remove the job and version from the specification as we already have them
+    service_parameters.pop('job', None)
+    service_parameters.pop('version', None)
+
+    # Remove the duplicated annotation-properties from the service_parameters
+    for values in (service_parameters.get('outputs') or {}).values():
+        if values.get('annotation-properties'):
+            values.pop('annotation-properties', None)
+
+    return service_parameters
+
+
+def _create_service_execution(
+    job_rendered_spec: Dict[str, Any],
+    service_parameters: Dict[str, Any],
+    username: str,
+    plan: _AnnotationPlan,
+) -> Optional[ServiceExecutionAnnotation]:
     """Creates a service execution annotation based on the input specification.
     A fields-descriptor is required in the output spec but the service-execution
     is optional. It is used to provide a 'service_ref'. If that is not supplied
@@ -433,28 +741,12 @@ def _create_service_execution(
         The service execution annotation
     """
 
-    # Get the fields descriptor from the output spec
-    fields_descriptor = output_spec["annotation-properties"]['fields-descriptor']
-    service_execution = output_spec["annotation-properties"].get(
-        'service-execution', {}
-    )
-
-    # Following a discussion on 04/05/2022 I've made this optional.
-    if 'service_ref' not in service_execution:
-        service_execution['service_ref'] = 'Not supplied'
+    # Get the fields descriptor from the output spec's plan
+    fields_descriptor = plan.fields_descriptor
 
     job = job_rendered_spec['job']
     version = job_rendered_spec['version']
 
-    # Remove the job and version from the specification as we already have them
-    job_rendered_spec.pop('job', None)
-    job_rendered_spec.pop('version', None)
-
-    # Remove the duplicated annotation-properties from the service_parameters
-    for values in job_rendered_spec['outputs'].values():
-        if values.get('annotation-properties'):
-            values.pop('annotation-properties', None)
-
     try:
         # service: str, - instance.job - checked when spec created
         # service_version: str - instance.version - checked when spec created
@@ -472,19 +764,44 @@ def _create_service_execution(
             username,
             # job_application_spec['name'],
             job,
-            service_execution['service_ref'],
-            job_rendered_spec,
+            plan.service_ref,
+            service_parameters,
             fields_descriptor['origin'],
             fields_descriptor['description'],
-            fields_descriptor['fields'],
+            plan.fields,
         )
-        return annotation.to_dict()
+        return annotation
     except AnnotationValidationError as e:
         basic_logger.info('AnnotationValidationError=%s', e.message)
     except Exception:  # pylint: disable=broad-except
         basic_logger.exception('Unexpected ServiceExecutionAnnotation exception')
 
 
+def _write_file(path: str, data: bytes) -> bool:
+    """Write the data to a file unless the file already has the same content
+    (i.e. the same content hash). The data is written to a temporary file that
+    is then renamed so that readers never see a partly written file.
+
+    Returns True if the file was written.
+    """
+    if os.path.isfile(path) and os.path.getsize(path) == len(data):
+        with open(path, 'rb') as existing_file:
+            existing_hash = hashlib.sha256(existing_file.read()).digest()
+        if existing_hash == hashlib.sha256(data).digest():
+            basic_logger.debug('Unchanged, not written (%s)', path)
+            return False
+
+    temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    try:
+        with open(temp_path, 'xb') as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return True
+
+
 def _get_params_filename(filepath: str) -> str:
     """Return the associated parameter filename for a particular
     filepath.
@@ -501,7 +818,7 @@ def _get_params_filename(filepath: str) -> str:
 
 
 def _create_param_file(
-    results_metadata: Dict[str, Any], result_path: str, result_filename: str
+    metadata: Metadata, result_path: str, result_filename: str
 ) -> str:
     """Creates a parameter file if requested from the fields that were added in
     Service Execution annotation.
@@ -509,26 +826,25 @@ def _create_param_file(
     """
     params_filename = _get_params_filename(result_filename)
     params_path = os.path.join(result_path, params_filename)
-    metadata = Metadata(**results_metadata)
 
     result_params = {
         key: values['description']
         for key, values in metadata.get_compiled_fields()['fields'].items()
     }
-    with open(params_path, 'wt', encoding='utf8') as params_file:
-        # Dump params of fields created
-        json.dump(result_params, params_file)
+    # Dump params of fields created
+    _write_file(params_path, json.dumps(result_params).encode('utf8'))
 
     return params_path
 
 
 def _create_annotations(
     project_directory: str,
-    job_application_spec: Dict[str, Any],
     job_rendered_spec: Dict[str, Any],
+    service_parameters: Dict[str, Any],
     output_spec: Dict[str, Any],
     username: str,
     create_param_file: bool = False,
+    metadata_codec: Optional[str] = None,
 ) -> Tuple[list, str]:
     """For each specified output file with a set of annotations-parameters,
     create a metadata file in the directory specified.
@@ -538,6 +854,11 @@ def _create_annotations(
     If create_param_file is set to True, then also create a json file containing a list of
     the parameters added to the SDF.
 
+    If a metadata_codec is set the metadata file is compressed with it.
+
+    The service_parameters (see _get_service_parameters) are shared with the job's
+    other outputs, and are not modified.
+
     Returns a list of meta files created and the parameter file if that has
     been created.
     """
@@ -560,13 +881,6 @@ def _create_annotations(
         )
         return meta_files, param_files
 
-    # Take service parameters from rendered specification and modify.
-    job_rendered_spec: Dict[str, Any] = copy.deepcopy(job_rendered_spec)
-
-    # Add any variables from the application spec
-    variables: Optional[Dict[str, Any]] = job_application_spec.get('variables')
-    job_rendered_spec['variables'] = variables
-
     # If there is a derived-from parameter in the spec's annotations
     # then there might be an existing travelling metadata file attached
     # to the input file. If it exists, any annotations should be added to it
@@ -575,28 +889,38 @@ def _create_annotations(
 
     if 'derived-from' in output_spec["annotation-properties"]:
         derived_from = output_spec["annotation-properties"]['derived-from']
-        source_file = job_rendered_spec['variables'][derived_from]
+        source_file = service_parameters['variables'][derived_from]
         derived_metadata = _get_derived_metadata(
             project_directory, username, source_file, derived_from
         )
     else:
         derived_metadata = _get_derived_metadata(project_directory, username)
 
+    plan = _get_annotation_plan(job_rendered_spec, output_spec)
+
     new_labels = []
-    if output_spec["annotation-properties"].get('labels'):
-        new_labels = _create_labels(output_spec)
-    basic_logger.debug('new_labels=%s', new_labels)
+    if plan.labels:
+        new_labels = _create_labels(plan)
+    basic_logger.debug('new_labels=%s', [label.to_dict() for label in new_labels])
 
-    se_annotation = _create_service_execution(job_rendered_spec, username, output_spec)
-    basic_logger.debug('se_annotation=%s', se_annotation)
+    se_annotation = _create_service_execution(
+        job_rendered_spec, service_parameters, username, plan
+    )
+    basic_logger.debug(
+        'se_annotation=%s', se_annotation.to_dict() if se_annotation else None
+    )
 
-    if se_annotation or new_labels:
-        results_metadata, results_schema = patch_travelling_metadata(
-            derived_metadata, annotations=se_annotation, labels=new_labels
-        )
-    else:
+    if not se_annotation and not new_labels:
         return meta_files, param_files
-    basic_logger.debug('results_metadata=%s', results_metadata)
+
+    # The results metadata is the derived metadata with the new labels and the
+    # SE annotation. The same (live) metadata is used to write the metadata,
+    # schema and parameter files.
+    metadata = Metadata(**derived_metadata)
+    for label in new_labels:
+        metadata.add_label(label)
+    if se_annotation:
+        metadata.add_annotation(se_annotation)
 
     result_dir = os.path.dirname(output_spec['creates'])
     result_filename = os.path.basename(output_spec['creates'])
@@ -614,18 +938,21 @@ def _create_annotations(
     results_metadata_path = os.path.join(result_path, results_metadata_filename)
     results_schema_path = os.path.join(result_path, results_schema_filename)
 
-    with open(results_metadata_path, 'wt', encoding='utf8') as meta_file:
-        # Dump metadata including the SE annotation
-        json.dump(results_metadata, meta_file)
-        meta_files.append(results_metadata_path)
+    # Dump metadata including the SE annotation (compressed if required).
+    # Files that are unchanged are not written again.
+    if metadata_codec:
+        results_metadata_data = metadata.to_json(codec=metadata_codec)
+    else:
+        results_metadata_data = metadata.to_json().encode('utf8')
+    _write_file(results_metadata_path, results_metadata_data)
+    meta_files.append(results_metadata_path)
 
-    with open(results_schema_path, 'wt', encoding='utf8') as schema_file:
-        # Dump metadata including the SE annotation
-        json.dump(results_schema, schema_file)
-        meta_files.append(results_schema_path)
+    results_schema = metadata.get_json_schema()
+    _write_file(results_schema_path, json.dumps(results_schema).encode('utf8'))
+    meta_files.append(results_schema_path)
 
     if create_param_file:
-        param_files = _create_param_file(results_metadata, result_path, result_filename)
+        param_files = _create_param_file(metadata, result_path, result_filename)
 
     return meta_files, param_files
 
@@ -636,6 +963,8 @@ def create_job_annotations(
     job_rendered_spec: Dict[str, Any],
     username: str,
     create_param_file: bool = False,
+    metadata_codec: Optional[str] = None,
+    max_workers: Optional[int] = None,
 ) -> list:
     """Update(Create) travelling metadata class(es) with Service Execution annotation generated
     from a Squonk job definition.
@@ -658,6 +987,12 @@ def create_job_annotations(
         create_param_file - (optional) If set to true a json dict will be written to a file
                             containing descriptions of the parameters added as part of the Service
                             Execution.
+        metadata_codec -    (optional) If set ('zlib' or 'gzip') the metadata files are
+                            compressed with the codec (see encode_metadata_json). Compressed
+                            metadata files are detected when they are read.
+        max_workers -       (optional) If set (to more than 1) the outputs are annotated
+                            concurrently, by (at most) this number of threads. The
+                            written files are returned in the same order either way.
 
     Returns:
         written_files: list - returns a list of metadata and schema files have been created
@@ -666,13 +1001,189 @@ def create_job_annotations(
     # Say Hello
     basic_logger.info('+ create_job_annotations')
 
-    written_files = []
+    annotated_outputs, create_annotations = _prepare_job_annotations(
+        project_directory,
+        job_application_spec,
+        job_rendered_spec,
+        username,
+        create_param_file,
+        metadata_codec,
+    )
+    if max_workers and max_workers > 1 and len(annotated_outputs) > 1:
+        # Annotations are mostly waiting on file I/O so threads are used.
+        # Results are returned (by map) in the order of the outputs.
+        with ThreadPoolExecutor(
+            max_workers=min(max_workers, len(annotated_outputs))
+        ) as executor:
+            results = list(executor.map(create_annotations, annotated_outputs))
+    else:
+        results = [create_annotations(output_spec) for output_spec in annotated_outputs]
+
+    return _get_written_files(project_directory, results)
+
+
+async def create_job_annotations_async(
+    project_directory: str,
+    job_application_spec: Dict[str, Any],
+    job_rendered_spec: Dict[str, Any],
+    username: str,
+    create_param_file: bool = False,
+    metadata_codec: Optional[str] = None,
+    executor: Optional[Executor] = None,
+) -> list:
+    """The asyncio counterpart of create_job_annotations, which writes the same
+    files (and returns the same list of written files).
+
+    The annotations of each output are created (reading the derived metadata,
+    validating and building the annotations, and encoding and writing the files)
+    in the executor, the event loop's default executor if one is not provided,
+    so that the event loop is not blocked and the outputs are handled concurrently.
+
+    If it is cancelled the outputs that have not been started are cancelled.
+    Those that have been started are completed, as files are written atomically
+    (see _write_file), but nothing is returned.
+    """
+
+    # Say Hello
+    basic_logger.info('+ create_job_annotations_async')
+
+    annotated_outputs, create_annotations = _prepare_job_annotations(
+        project_directory,
+        job_application_spec,
+        job_rendered_spec,
+        username,
+        create_param_file,
+        metadata_codec,
+    )
+    loop = asyncio.get_running_loop()
+    # The results are gathered in the order of the outputs.
+    results = await asyncio.gather(
+        *[
+            loop.run_in_executor(executor, create_annotations, output_spec)
+            for output_spec in annotated_outputs
+        ]
+    )
+
+    return _get_written_files(project_directory, results)
+
+
+def create_job_annotations_batch(
+    job_instances: List[Tuple[str, Dict[str, Any], Dict[str, Any], str]],
+    create_param_file: bool = False,
+    metadata_codec: Optional[str] = None,
+    max_workers: Optional[int] = None,
+) -> List[Tuple[list, Optional[str]]]:
+    """Create the job annotations (see create_job_annotations) for a batch of job
+    instances, e.g. when annotations are back-filled.
+
+    The instances are grouped by job definition (job and version) so that the
+    instances of a job share its annotation plans (see _get_annotation_plan) and
+    the derived metadata (see _DerivedMetadataCache) cached by a process.
+    A failure of one instance does not stop the others.
+
+    Args:
+        job_instances: list of (project_directory, job_application_spec,
+            job_rendered_spec, username) - see create_job_annotations.
+        create_param_file (optional)
+        metadata_codec (optional)
+        max_workers (optional): if set (to more than 1) the groups (split into
+            chunks if they are large) are handled by a pool of (up to) this many
+            processes.
+
+    Returns:
+        list of (written_files, error) in the order of job_instances. The error is
+        None, or a message if the instance's annotations could not be created.
+    """
+    groups: Dict[Tuple[str, str], List[int]] = {}
+    for index, job_instance in enumerate(job_instances):
+        job_rendered_spec = job_instance[2]
+        job_definition = (
+            job_rendered_spec.get('job'),
+            job_rendered_spec.get('version'),
+        )
+        groups.setdefault(job_definition, []).append(index)
+    create_group = functools.partial(
+        _create_job_annotations_group,
+        create_param_file=create_param_file,
+        metadata_codec=metadata_codec,
+    )
+
+    results: List[Tuple[list, Optional[str]]] = [([], None)] * len(job_instances)
+    if not max_workers or max_workers <= 1 or len(job_instances) <= 1:
+        for indexes in groups.values():
+            group_results = create_group([job_instances[index] for index in indexes])
+            for index, result in zip(indexes, group_results):
+                results[index] = result
+        return results
+
+    # Send the instances to the workers in chunks of (about 4 per worker)
+    # of the same job definition.
+    chunksize = max(1, len(job_instances) // (max_workers * 4))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for indexes in groups.values():
+            for start in range(0, len(indexes), chunksize):
+                chunk = indexes[start : start + chunksize]
+                future = executor.submit(
+                    create_group, [job_instances[index] for index in chunk]
+                )
+                futures[future] = chunk
+        for future, chunk in futures.items():
+            try:
+                chunk_results = future.result()
+            except Exception as ex:  # pylint: disable=broad-except
+                # The chunk could not be handled (e.g. its worker failed)
+                basic_logger.exception('Unexpected create_job_annotations_batch error')
+                chunk_results = [([], f'{type(ex).__name__}: {ex}')] * len(chunk)
+            for index, result in zip(chunk, chunk_results):
+                results[index] = result
+    return results
+
+
+def _create_job_annotations_group(
+    job_instances: List[Tuple[str, Dict[str, Any], Dict[str, Any], str]],
+    create_param_file: bool,
+    metadata_codec: Optional[str],
+) -> List[Tuple[list, Optional[str]]]:
+    """Create the job annotations for a group of job instances, returning the
+    written files and error (or None) of each (see create_job_annotations_batch).
+    """
+    results = []
+    for job_instance in job_instances:
+        project_directory = job_instance[0]
+        try:
+            written_files = create_job_annotations(
+                *job_instance, create_param_file, metadata_codec
+            )
+            results.append((written_files, None))
+        except Exception as ex:  # pylint: disable=broad-except
+            basic_logger.exception(
+                'Unexpected create_job_annotations error (%s)', project_directory
+            )
+            results.append(([], f'{type(ex).__name__}: {ex}'))
+    return results
+
+
+def _prepare_job_annotations(
+    project_directory: str,
+    job_application_spec: Dict[str, Any],
+    job_rendered_spec: Dict[str, Any],
+    username: str,
+    create_param_file: bool,
+    metadata_codec: Optional[str],
+) -> Tuple[
+    List[Dict[str, Any]], Optional[Callable[[Dict[str, Any]], Tuple[list, str]]]
+]:
+    """Returns the output specifications of a job that have annotation-properties
+    and the function that creates (and writes) the annotations for one of them.
+    """
+
     outputs: Optional[Dict[str, Any]] = job_rendered_spec.get('outputs')
     if not outputs:
         basic_logger.info(
             'No outputs found in the rendered specification (%s)', project_directory
         )
-        return written_files
+        return [], None
 
     # Loop through the output specifications for the different outputs
     basic_logger.info(
@@ -680,32 +1191,51 @@ def create_job_annotations(
         len(outputs),
         project_directory,
     )
+    annotated_outputs = []
     for output_spec in outputs.values():
         if output_spec.get('annotation-properties'):
-            basic_logger.info(
-                'Found annotation-properties. Creating annotations... (%s)',
-                project_directory,
-            )
-            meta, param_file = _create_annotations(
-                project_directory,
-                job_application_spec,
-                job_rendered_spec,
-                output_spec,
-                username,
-                create_param_file,
-            )
-
-            basic_logger.info('meta_files=%s (%s)', meta, project_directory)
-            basic_logger.info('param_files=%s (%s)', param_file, project_directory)
-            written_files.extend(meta)
-            if param_file:
-                written_files.append(param_file)
+            annotated_outputs.append(output_spec)
         else:
             basic_logger.info(
                 'No annotation-properties in output spec (%s) (%s)',
                 output_spec,
                 project_directory,
             )
+    if not annotated_outputs:
+        return [], None
+
+    # The service parameters are the same for each output
+    service_parameters = _get_service_parameters(
+        job_application_spec, job_rendered_spec
+    )
+    basic_logger.info(
+        'Found annotation-properties. Creating annotations for %d outputs... (%s)',
+        len(annotated_outputs),
+        project_directory,
+    )
+    return annotated_outputs, functools.partial(
+        _create_annotations,
+        project_directory,
+        job_rendered_spec,
+        service_parameters,
+        username=username,
+        create_param_file=create_param_file,
+        metadata_codec=metadata_codec,
+    )
+
+
+def _get_written_files(project_directory: str, results: List[Tuple[list, str]]) -> list:
+    """Returns the files written for a job from the (ordered) results of
+    _create_annotations for each of its outputs.
+    """
+
+    written_files = []
+    for meta, param_file in results:
+        basic_logger.info('meta_files=%s (%s)', meta, project_directory)
+        basic_logger.info('param_files=%s (%s)', param_file, project_directory)
+        written_files.extend(meta)
+        if param_file:
+            written_files.append(param_file)
 
     basic_logger.info('Done (%s). Written: %s', project_directory, written_files)
 
@@ -6,15 +6,22 @@ The other classes should be searialisable without pickling hopefully:
 Hints: https://pynative.com/make-python-class-json-serializable/
 """
 
+import bisect
 import json
 import datetime
 import logging
 import copy
-from typing import Any, Dict, List, Optional
+import functools
+import hashlib
+import time
+import gzip
+import zlib
+from typing import Any, Dict, List, Optional, Tuple, Union
 from abc import ABC, abstractmethod
 import re
 
-from decoder import decoder
+import jinja2
+from jinja2.meta import find_undeclared_variables
 import yaml
 
 from .exceptions import ANNOTATION_ERRORS, AnnotationValidationError
@@ -30,11 +37,46 @@ _SCHEMA: str = 'http://json-schema.org/draft/2019-09/schema#'
 _SCHEMA_ID: str = 'https://example.com/product.schema.json'
 _ANNOTATIONS_EXT = '.annotations'
 
+# Compressed metadata JSON is written in an envelope: a header of the magic bytes,
+# the envelope version and the codec, followed by the compressed (utf8) JSON.
+_ENVELOPE_MAGIC: bytes = b'DMM'
+_ENVELOPE_VERSION: int = 1
+_ENVELOPE_CODECS: Dict[str, int] = {'zlib': 1, 'gzip': 2}
+
 
 # This is the basic structure of the rows FieldsDescriptorAnnotation fields
 # list that is indexed by the field name.
 FIELD_DICT = {'type': '', 'description': '', 'required': False, 'active': False}
 
+# The annotation types that contribute fields to the compiled fields of a dataset.
+_FIELDS_ANNOTATION_TYPES = ('FieldsDescriptorAnnotation', 'ServiceExecutionAnnotation')
+
+# The implicit label types (see LabelAnnotation).
+_LABEL_TYPES = ('plain', 'hash', 'address')
+
+# The (compiled) patterns used to validate FieldsDescriptorAnnotation fields, as
+# every field is validated again when the fields of a dataset are compiled.
+_FIELD_NAME_PATTERN = re.compile(
+    ANNOTATION_ERRORS['FieldsDescriptorAnnotation']['3']['regex']
+)
+_FIELD_DESCRIPTION_PATTERN = re.compile(
+    ANNOTATION_ERRORS['FieldsDescriptorAnnotation']['5']['regex']
+)
+
+# Timestamps are held as integer microseconds since the epoch (UTC) and only
+# formatted (as ISO 8601) when the metadata is serialised.
+_EPOCH: datetime.datetime = datetime.datetime(1970, 1, 1)
+_EPOCH_ORDINAL: int = _EPOCH.toordinal()
+
+# The number of compiled field expressions (see get_field_expression) that are
+# cached. Job specifications use a small number of (often repeated) expressions.
+_FIELD_EXPRESSION_CACHE_SIZE: int = 1024
+
+# The number of changes made to annotations. Each annotation records the number
+# of its last change (see Annotation._reset_cache) so that metadata can tell if
+# annotations already in its compiled fields or content hash have changed.
+_annotation_revision: int = 0
+
 
 def get_metadata_version() -> str:
     return _METADATA_VERSION
@@ -44,6 +86,44 @@ def get_annotation_version() -> str:
     return _ANNOTATION_VERSION
 
 
+def encode_metadata_json(json_text: str, codec: str = 'zlib') -> bytes:
+    """Return metadata JSON compressed with the codec (zlib or gzip) in an
+    envelope that identifies the codec (see decode_metadata_json).
+    """
+    if codec not in _ENVELOPE_CODECS:
+        raise ValueError(f'Unknown metadata codec "{codec}"')
+    data = json_text.encode('utf8')
+    if codec == 'zlib':
+        payload = zlib.compress(data)
+    else:
+        payload = gzip.compress(data, mtime=0)
+    header = _ENVELOPE_MAGIC + bytes([_ENVELOPE_VERSION, _ENVELOPE_CODECS[codec]])
+    return header + payload
+
+
+def decode_metadata_json(data: Union[str, bytes]) -> str:
+    """Return the JSON text of metadata that is either plain JSON (text or
+    utf8 bytes) or compressed in an envelope by encode_metadata_json.
+    """
+    if isinstance(data, str):
+        return data
+    if not data.startswith(_ENVELOPE_MAGIC):
+        return data.decode('utf8')
+
+    header_length = len(_ENVELOPE_MAGIC) + 2
+    if len(data) < header_length:
+        raise ValueError('Unsupported metadata envelope (truncated header)')
+    version, codec_id = data[len(_ENVELOPE_MAGIC) : header_length]
+    if version != _ENVELOPE_VERSION:
+        raise ValueError(f'Unsupported metadata envelope version {version}')
+    payload = data[header_length:]
+    if codec_id == _ENVELOPE_CODECS['zlib']:
+        return zlib.decompress(payload).decode('utf8')
+    if codec_id == _ENVELOPE_CODECS['gzip']:
+        return gzip.decompress(payload).decode('utf8')
+    raise ValueError(f'Unknown metadata codec {codec_id}')
+
+
 def get_annotation_filename(filename: str) -> str:
     """Return the associated annotations filename for a particular file
     This is very simple, but best done the same way everywhere!
@@ -52,6 +132,180 @@ def get_annotation_filename(filename: str) -> str:
     return filename + _ANNOTATIONS_EXT
 
 
+def load_annotations_json(annotations_json: str) -> List[Dict[str, Any]]:
+    """Return the annotations (in dictionary form) in the text of an annotations
+    file. This may be JSON (an annotation or a list of annotations) or JSON Lines
+    (an annotation on each line, see md_manage.py).
+    """
+    try:
+        annotations = json.loads(annotations_json)
+    except json.JSONDecodeError:
+        # JSON Lines (blank lines are ignored)
+        return [
+            json.loads(line) for line in annotations_json.splitlines() if line.strip()
+        ]
+    if isinstance(annotations, dict):
+        return [annotations]
+    return annotations
+
+
+def get_canonical_json(value: Any) -> str:
+    """Return the canonical JSON of a value (e.g. metadata or a json schema in
+    dictionary form). Keys are sorted, there is no whitespace and numbers have
+    Python's (shortest round-trip) formatting, so equal values give equal JSON.
+    """
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+def get_content_hash(value: Any) -> str:
+    """Return a hash (sha256) of the canonical JSON of a value."""
+    return hashlib.sha256(get_canonical_json(value).encode('utf8')).hexdigest()
+
+
+def _chain_hash(chain_hash: str, value: Any) -> str:
+    """Return the next hash in a chain of hashes (of a list of values)."""
+    return hashlib.sha256(
+        (chain_hash + get_canonical_json(value)).encode('utf8')
+    ).hexdigest()
+
+
+def get_labels_fingerprint(labels: Dict[str, Any]) -> str:
+    """Return a fingerprint of a set of labels (label: value), e.g. the labels
+    of a json schema. The fingerprint does not depend on the order of the labels.
+    """
+    canonical = json.dumps(sorted(labels.items()), separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf8')).hexdigest()
+
+
+def get_service_parameters_hash(service_parameters: Dict[str, Any]) -> str:
+    """Return the hash (content address) of a set of service parameters. This is
+    used as the reference to the parameters in compact metadata (see
+    Metadata.to_dict).
+    """
+    canonical = json.dumps(
+        service_parameters, sort_keys=True, separators=(',', ':'), default=str
+    )
+    return hashlib.sha256(canonical.encode('utf8')).hexdigest()
+
+
+def _now() -> int:
+    """Return the current (UTC) time in microseconds since the epoch"""
+    return time.time_ns() // 1000
+
+
+class _OffsetTimestamp(int):
+    """A timestamp (microseconds since the epoch, UTC) that was given with a UTC
+    offset. It compares as the UTC time, but keeps the ISO 8601 text of the time
+    with its offset so that it is serialised unchanged.
+    """
+
+    def __new__(cls, timestamp: int, text: str):
+        offset_timestamp = super().__new__(cls, timestamp)
+        offset_timestamp.text = text
+        return offset_timestamp
+
+    def __reduce__(self):
+        return _OffsetTimestamp, (int(self), self.text)
+
+
+def _parse_timestamp(timestamp: str) -> int:
+    """Return an ISO 8601 timestamp (e.g. '2021-06-01T10:15:20.123456') as
+    microseconds since the epoch. Timestamps with a UTC offset are converted to
+    UTC, keeping the offset for when they are formatted (see _OffsetTimestamp).
+    """
+    parsed = datetime.datetime.fromisoformat(timestamp)
+    utc = parsed
+    if parsed.tzinfo is not None:
+        utc = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    days = utc.toordinal() - _EPOCH_ORDINAL
+    seconds = days * 86400 + utc.hour * 3600 + utc.minute * 60 + utc.second
+    microseconds = seconds * 1000000 + utc.microsecond
+    if parsed.tzinfo is not None:
+        return _OffsetTimestamp(microseconds, parsed.isoformat())
+    return microseconds
+
+
+def _format_timestamp(timestamp: int) -> str:
+    """Return a timestamp (microseconds since the epoch) in ISO 8601 format,
+    i.e. as datetime.isoformat() would for the datetime it was parsed from.
+    """
+    if isinstance(timestamp, _OffsetTimestamp):
+        return timestamp.text
+    return _format_utc_timestamp(timestamp)
+
+
+@functools.lru_cache(maxsize=1024)
+def _format_utc_timestamp(timestamp: int) -> str:
+    """Return a (UTC) timestamp in ISO 8601 format (without an offset)."""
+    return (_EPOCH + datetime.timedelta(microseconds=timestamp)).isoformat()
+
+
+def _is_formatted_timestamp(timestamp: str) -> bool:
+    """Return True if an ISO 8601 timestamp is in the form returned by
+    _format_timestamp (checked without parsing it).
+    """
+    if len(timestamp) == 19:
+        return timestamp[10] == 'T'
+    return (
+        len(timestamp) == 26
+        and timestamp[10] == 'T'
+        and timestamp[19] == '.'
+        and timestamp[20:] != '000000'
+    )
+
+
+def _normalise_annotation_dict(annotation_row: Dict[str, Any]) -> Dict[str, Any]:
+    """Return the (stored) dictionary form of an annotation as the annotation
+    would serialise it once it is created (see Annotation.load_dict), i.e. with the
+    current annotation version and the created time in ISO 8601 format.
+    The row is only copied if it has to be changed.
+    """
+    annotation_version = get_annotation_version()
+    created = annotation_row.get('created')
+    if created and not _is_formatted_timestamp(created):
+        created = _format_timestamp(_parse_timestamp(created))
+    if annotation_row.get(
+        'annotation_version'
+    ) == annotation_version and created == annotation_row.get('created'):
+        return annotation_row
+    normalised_row = {
+        'type': annotation_row['type'],
+        'created': created,
+        'annotation_version': annotation_version,
+    }
+    for key, value in annotation_row.items():
+        if key not in normalised_row:
+            normalised_row[key] = value
+    if not created:
+        del normalised_row['created']
+    return normalised_row
+
+
+def _get_annotation_type(annotation: Any) -> str:
+    """Return the type of an annotation held as an object or in dictionary form"""
+    if isinstance(annotation, dict):
+        return annotation['type']
+    return annotation.get_type()
+
+
+def _get_annotation_dict(annotation: Any) -> Dict[str, Any]:
+    """Return the dictionary form of an annotation held as an object or in
+    dictionary form (without creating the object).
+    """
+    if isinstance(annotation, dict):
+        return annotation
+    return annotation.to_dict()
+
+
+def _get_annotation_json(annotation: Any) -> str:
+    """Return the JSON form of an annotation held as an object or in
+    dictionary form.
+    """
+    if isinstance(annotation, dict):
+        return json.dumps(annotation)
+    return annotation.to_json()
+
+
 class Metadata:
     """Class Metadata
 
@@ -73,6 +327,7 @@ class Metadata:
         labels: List = None,
         dataset_version: int = None,
         synchronised_datetime: str = None,
+        service_parameters_table: Dict[str, Any] = None,
     ):
         assert dataset_name
         assert dataset_id
@@ -83,15 +338,14 @@ class Metadata:
         self.description = description
         self.created_by = created_by
 
+        # Timestamps are held in microseconds since the epoch.
         if created:
-            self.created = datetime.datetime.strptime(created, '%Y-%m-%dT%H:%M:%S.%f')
+            self.created = _parse_timestamp(created)
         else:
-            self.created = datetime.datetime.utcnow()
+            self.created = _now()
 
         if last_updated:
-            self.last_updated = datetime.datetime.strptime(
-                last_updated, '%Y-%m-%dT%H:%M:%S.%f'
-            )
+            self.last_updated = _parse_timestamp(last_updated)
         else:
             self.last_updated = self.created
 
@@ -100,15 +354,50 @@ class Metadata:
         else:
             self.metadata_version = get_metadata_version()
 
-        self.annotations = []
+        # The service parameters of the ServiceExecution annotations indexed by
+        # their hash. Annotations with the same parameters share them, and compact
+        # metadata refers to them by their hash (see to_dict).
+        self._service_parameters_table: Dict[str, Any] = dict(
+            service_parameters_table or {}
+        )
+
+        # The annotations list. Annotations loaded from trusted metadata are held
+        # in their dictionary form until they are used (see get_annotation).
+        self._annotations: List[Any] = []
+        # All the fields in the dataset compiled from the FieldDescriptor
+        # annotations. This is brought up to date with any annotations added
+        # since it was last used (see _get_compiled_fields).
+        self._compiled_fields = FieldsDescriptorAnnotation()
+        self._compiled_count = 0
+        # Chained hashes of the annotations and labels (see get_content_hash) and
+        # how many of each have been included in them.
+        self._annotations_hash = ''
+        self._hashed_annotations_count = 0
+        self._labels_hash = ''
+        self._hashed_labels_count = 0
+        # The annotation revision when the annotations (and labels) in the compiled
+        # fields and hashes were last known to be unchanged.
+        self._checked_revision = 0
+        # The annotations and labels are not copied here as the annotation objects
+        # created from them copy anything they keep.
         if annotations:
-            annos_copy = copy.deepcopy(annotations)
-            self.add_annotations(annos_copy, init=True)
+            self.add_annotations(annotations, init=True)
 
         self.labels = []
+        # The latest version of each label indexed by the label name, and the
+        # same labels bucketed by label type. Each index is kept in the order
+        # in which the labels were (last) applied.
+        self._latest_labels: Dict[str, LabelAnnotation] = {}
+        self._latest_labels_by_type: Dict[str, Dict[str, LabelAnnotation]] = {
+            label_type: {} for label_type in _LABEL_TYPES
+        }
+        # All the labels ordered by their created time (with a parallel list
+        # of the created times) so we can find the labels applied after a
+        # given (synchronisation) time with a binary search.
+        self._labels_by_created: List[LabelAnnotation] = []
+        self._label_created: List[int] = []
         if labels:
-            labels_copy = copy.deepcopy(labels)
-            for label_row in labels_copy:
+            for label_row in labels:
                 self._create_label(label_row)
 
         if dataset_version:
@@ -117,14 +406,46 @@ class Metadata:
             self.dataset_version = _MASTER_VERSION
 
         if synchronised_datetime:
-            self.synchronised_datetime = datetime.datetime.strptime(
-                synchronised_datetime, '%Y-%m-%dT%H:%M:%S.%f'
-            )
+            self.synchronised_datetime = _parse_timestamp(synchronised_datetime)
         else:
-            self.synchronised_datetime = datetime.datetime.strptime(
-                _DEFAULT_SYNC_TIME, '%Y-%m-%dT%H:%M:%S.%f'
+            self.synchronised_datetime = _parse_timestamp(_DEFAULT_SYNC_TIME)
+
+    @classmethod
+    def from_dict(cls, metadata_dict: Dict[str, Any], trusted: bool = False):
+        """Create a Metadata object from the dictionary form returned by to_dict().
+
+        Normally the annotations and labels are copied and validated as they are
+        re-created. If trusted is set (e.g. for metadata that has been read back from
+        the data tier, where it was validated when it was written) they are
+        re-created without validation and without copying, so the dictionary must
+        not be changed afterwards.
+        """
+        if not trusted:
+            return cls(**metadata_dict)
+
+        metadata_params = dict(metadata_dict)
+        annotations = metadata_params.pop('annotations', None)
+        labels = metadata_params.pop('labels', None)
+        metadata = cls(**metadata_params)
+
+        if annotations:
+            if 'type' in annotations:
+                # Only one annotation in the dict.
+                annotations = [annotations]
+            # The annotations are only created as objects when they are used.
+            # Until then they are held in the form they will serialise to.
+            metadata._annotations.extend(
+                _normalise_annotation_dict(metadata._expand_annotation_dict(annotation))
+                for annotation in annotations
             )
 
+        for label_row in labels or []:
+            label = LabelAnnotation.from_dict(label_row)
+            metadata.labels.append(label)
+            metadata._index_label(label)
+
+        return metadata
+
     def get_dataset_name(self):
         return self.dataset_name
 
@@ -173,23 +494,124 @@ class Metadata:
         self.dataset_version = dataset_version
 
     def get_synchronised_datetime(self):
-        return self.synchronised_datetime.isoformat()
+        return _format_timestamp(self.synchronised_datetime)
 
     def set_synchronised_datetime(self):
         # Note that no property change annotation is set here as this is
         # a technical field.
-        self.synchronised_datetime = datetime.datetime.utcnow()
+        self.synchronised_datetime = _now()
 
     def get_annotation(self, pos: int):
         """Get an annotation from the annotation list identified by the
         position.
         """
-        return self.annotations[pos]
+        annotation = self._annotations[pos]
+        if isinstance(annotation, dict):
+            annotation = _ANNOTATION_CLASSES[annotation['type']].from_dict(annotation)
+            self._annotations[pos] = annotation
+        return annotation
+
+    @property
+    def annotations(self) -> List['Annotation']:
+        """The annotations list (with every annotation created as an object)."""
+        for pos in range(len(self._annotations)):
+            self.get_annotation(pos)
+        return self._annotations
+
+    def _discard_changed_state(self):
+        """Discard the compiled fields and the chained hashes if any of the
+        annotations (or labels) in them have changed since they were last brought
+        up to date, so that they are built again. Annotations rarely change once
+        they have been added, so they are only checked if some annotation (of any
+        metadata) has changed.
+        """
+        if self._checked_revision == _annotation_revision:
+            return
+        # pylint: disable=protected-access
+        for pos in range(max(self._compiled_count, self._hashed_annotations_count)):
+            annotation = self._annotations[pos]
+            # Annotations held in their dictionary form have not changed.
+            if isinstance(annotation, dict):
+                continue
+            if annotation._revision > self._checked_revision:
+                if pos < self._compiled_count:
+                    self._compiled_fields = FieldsDescriptorAnnotation()
+                    self._compiled_count = 0
+                if pos < self._hashed_annotations_count:
+                    self._annotations_hash = ''
+                    self._hashed_annotations_count = 0
+                break
+        for label in self.labels[: self._hashed_labels_count]:
+            if label._revision > self._checked_revision:
+                self._labels_hash = ''
+                self._hashed_labels_count = 0
+                break
+        # pylint: enable=protected-access
+        self._checked_revision = _annotation_revision
+
+    def _get_compiled_fields(self) -> 'FieldsDescriptorAnnotation':
+        """Returns the compiled fields after folding in the fields of any
+        FieldDescriptor (or ServiceExecution) annotations added since they were last
+        compiled. The fields are compiled again if an annotation in them has changed.
+        """
+        self._discard_changed_state()
+        for pos in range(self._compiled_count, len(self._annotations)):
+            annotation = self._annotations[pos]
+            if _get_annotation_type(annotation) in _FIELDS_ANNOTATION_TYPES:
+                # Annotations held in their dictionary form are not created
+                # just to get their fields.
+                if isinstance(annotation, dict):
+                    fields = annotation.get('fields') or {}
+                else:
+                    fields = annotation.get_fields(True)
+                # Allow for validation errors in old field descriptors.
+                try:
+                    self._compiled_fields.merge_fields(fields)
+                except AnnotationValidationError:
+                    pass
+        self._compiled_count = len(self._annotations)
+        # Compiling the fields changes the compiled fields annotation only.
+        self._checked_revision = _annotation_revision
+        return self._compiled_fields
+
+    def _expand_annotation_dict(self, annotation_row: dict) -> dict:
+        """Return the dictionary form of an annotation with any reference to
+        service parameters (in compact metadata) replaced by the parameters.
+        """
+        if 'service_parameters_ref' not in annotation_row:
+            return annotation_row
+        expanded_row = {
+            key: value
+            for key, value in annotation_row.items()
+            if key != 'service_parameters_ref'
+        }
+        expanded_row['service_parameters'] = self._service_parameters_table[
+            annotation_row['service_parameters_ref']
+        ]
+        return expanded_row
+
+    def _intern_service_parameters(self, annotation: 'ServiceExecutionAnnotation'):
+        """Share the service parameters of the annotation with any other
+        annotations that have the same parameters.
+        """
+        service_parameters = annotation.get_service_parameters()
+        shared_parameters = self._service_parameters_table.setdefault(
+            get_service_parameters_hash(service_parameters), service_parameters
+        )
+        if shared_parameters is not service_parameters:
+            annotation.service_parameters = shared_parameters
+            # The job spec (of the fields) is the annotation's own copy of the
+            # parameters, so it is shared too.
+            if annotation.spec is service_parameters:
+                annotation.spec = shared_parameters
+            annotation._reset_cache()  # pylint: disable=protected-access
 
     def add_annotation(self, annotation: object):
         """Add a serialized annotation to the annotation list"""
-        self.annotations.append(annotation)
-        self.last_updated = datetime.datetime.utcnow()
+        if isinstance(annotation, ServiceExecutionAnnotation):
+            self._intern_service_parameters(annotation)
+        self._annotations.append(annotation)
+        self.last_updated = _now()
 
     def get_annotations_dict(self, annotation_type=all):
         """Get a list of all annotations from the annotation list in dict
@@ -200,11 +622,11 @@ class Metadata:
             filter within a particular class.
         """
         anno_list = []
-        for anno in self.annotations:
+        for anno in self._annotations:
             if annotation_type is all:
-                anno_list.append(anno.to_dict())
-            elif anno.get_type() is annotation_type:
-                anno_list.append(anno.to_dict())
+                anno_list.append(_get_annotation_dict(anno))
+            elif _get_annotation_type(anno) == annotation_type:
+                anno_list.append(_get_annotation_dict(anno))
         return anno_list
 
     def get_annotations_json(self, annotation_type=all):
@@ -217,44 +639,30 @@ class Metadata:
         """Creates an annotation object based on the dictionary and add to the
         annotations list.
         """
-        class_lookup = {
-            'PropertyChangeAnnotation': PropertyChangeAnnotation,
-            'FieldsDescriptorAnnotation': FieldsDescriptorAnnotation,
-            'ServiceExecutionAnnotation': ServiceExecutionAnnotation,
-        }
-
-        # Get class and original create data
-        annotation_class = annotation_row['type']
-        annotation_created = None
-        # Remove from parameter list
-        del annotation_row['type']
-
-        # Remove unused elements if they exist
-        if 'created' in annotation_row:
-            annotation_created = annotation_row['created']
-            del annotation_row['created']
-        if 'annotation_version' in annotation_row:
-            del annotation_row['annotation_version']
+        # Get class and original create data and remove them (and any unused
+        # elements) from the parameter list. The row itself is not changed.
+        annotation_params = dict(self._expand_annotation_dict(annotation_row))
+        annotation_class = annotation_params.pop('type')
+        annotation_created = annotation_params.pop('created', None)
+        annotation_params.pop('annotation_version', None)
 
         # Create new annotation for metadata using rest of original parameters
         # and reset created datetime. This also effectively validates the
         # content.
-        annotation = class_lookup[annotation_class](**annotation_row)
+        annotation = _ANNOTATION_CLASSES[annotation_class](**annotation_params)
         if annotation_created:
             annotation.set_created(annotation_created)
-        self.annotations.append(annotation)
+        if isinstance(annotation, ServiceExecutionAnnotation):
+            self._intern_service_parameters(annotation)
+        self._annotations.append(annotation)
 
     def add_annotations(self, annotations_list: dict, init=False):
-        """Add a list of annotations in json format to the annotation list"""
-        # Note that this also validates the Json and returns a ValueError if
-        # not valid
-        # annotations_list = json.loads(annotations)
-
-        # If a single annotation is provided but it's simply not in a list then
-        # add it
-        # if annotations.lstrip()[0] != '[':
-        #    annotations_list = []
-        #    annotations_list.append(json.loads(annotations))
+        """Add a list of annotations in json format to the annotation list.
+        The annotations may also be the text of an annotations file, in JSON or
+        JSON Lines (see load_annotations_json).
+        """
+        if isinstance(annotations_list, str):
+            annotations_list = load_annotations_json(annotations_list)
 
         if 'type' in annotations_list:
             # Only one annotation in the dict.
@@ -265,7 +673,18 @@ class Metadata:
                 self._create_annotation(annotation_row)
 
         if not init:
-            self.last_updated = datetime.datetime.utcnow()
+            self.last_updated = _now()
+
+    def merge_annotations(self, metadata: 'Metadata'):
+        """Add the annotations of another Metadata object to the annotation list.
+        As annotations are not expected to change once they have been added to the
+        metadata they are shared (in whatever form they are held) rather than
+        being copied and validated again.
+        """
+        self._annotations.extend(
+            metadata._annotations  # pylint: disable=protected-access
+        )
+        self.last_updated = _now()
 
     def _create_label(self, label_row: dict):
         """Creates an annotation object based on the dictionary and add to the
@@ -273,67 +692,98 @@ class Metadata:
         """
         class_lookup = {'LabelAnnotation': LabelAnnotation}
 
-        # Get class and original create data
-        label_class = label_row['type']
-        label_created = None
-        # Remove from parameter list
-        del label_row['type']
-
-        # Remove unused elements if they exist
-        if 'created' in label_row:
-            label_created = label_row['created']
-            del label_row['created']
-        if 'annotation_version' in label_row:
-            del label_row['annotation_version']
+        # Get class and original create data and remove them (and any unused
+        # elements) from the parameter list. The row itself is not changed.
+        label_params = dict(label_row)
+        label_class = label_params.pop('type')
+        label_created = label_params.pop('created', None)
+        label_params.pop('annotation_version', None)
 
         # Create new label for metadata using rest of original parameters
         # and reset created datetime. This also effectively validates the
         # content.
-        label = class_lookup[label_class](**label_row)
+        label = class_lookup[label_class](**label_params)
         if label_created:
             label.set_created(label_created)
         self.labels.append(label)
+        self._index_label(label)
+
+    def _index_label(self, label: object):
+        """Record the label as the latest version of the label."""
+        name = label.get_label()
+        # Remove and re-insert so the index stays in the order labels are applied.
+        self._latest_labels.pop(name, None)
+        self._latest_labels[name] = label
+        bucket = self._latest_labels_by_type[label.get_label_type()]
+        bucket.pop(name, None)
+        bucket[name] = label
+        # Labels are normally applied in time order so this is usually an append.
+        # Labels with the same created datetime are kept in the order applied.
+        position = bisect.bisect_right(self._label_created, label.created)
+        self._label_created.insert(position, label.created)
+        self._labels_by_created.insert(position, label)
+
+    def _get_labels_created_from(
+        self, synchronised_datetime: str, inclusive: bool = False
+    ) -> List['LabelAnnotation']:
+        """Returns the labels created after the given datetime (or at the
+        datetime if inclusive is set) in created order.
+        """
+        compare_time = _parse_timestamp(synchronised_datetime)
+        if inclusive:
+            position = bisect.bisect_left(self._label_created, compare_time)
+        else:
+            position = bisect.bisect_right(self._label_created, compare_time)
+        return self._labels_by_created[position:]
 
     def add_label(self, label: object):
         """Add a serialized annotation to the annotation list"""
         self.labels.append(label)
-        self.last_updated = datetime.datetime.utcnow()
+        self._index_label(label)
+        self.last_updated = _now()
 
     def add_labels(self, labels_list: dict):
         """Add a list of labels in dict format to the labels list"""
         for label_row in labels_list:
             self._create_label(label_row)
-        self.last_updated = datetime.datetime.utcnow()
+        self.last_updated = _now()
 
     def get_labels_existing_dataset(self, synchronised_datetime: str):
         """Get a list of the labels from the labels list that were applied
         after a given datetime (used for synchronising travelling metadata with
         an existing dataset when adding labels
         """
-        compare_datetime = datetime.datetime.strptime(
-            synchronised_datetime, '%Y-%m-%dT%H:%M:%S.%f'
-        )
-
         return [
-            label.to_dict() for label in self.labels if label.created > compare_datetime
+            label.to_dict()
+            for label in self._get_labels_created_from(synchronised_datetime)
         ]
 
     def get_labels_new_dataset(self, synchronised_datetime: str):
         """Get the subset of the labels from the from travelling metadat that with
         be applied when creating a new dataset. These are:
-        1. plane labels after the synchronised-datetime (i.e. created by the job)
-        2. any hash or address labels.
+        1. any active hash or address labels.
+        2. active plane labels after the synchronised-datetime (i.e. created by the job)
         """
 
-        active_labels = self.get_labels(active=True)
-        for label in active_labels:
-            if (
-                label['label'][0] not in ['#', '@']
-                and label['created'] < synchronised_datetime
-            ):
-                active_labels.remove(label)
+        new_labels = [
+            label.to_dict()
+            for label_type in ['hash', 'address']
+            for label in reversed(self._latest_labels_by_type[label_type].values())
+            if label.get_active()
+        ]
+
+        # Only the latest version of a plain label is used.
+        latest_plain_labels = self._latest_labels_by_type['plain']
+        new_labels.extend(
+            label.to_dict()
+            for label in self._get_labels_created_from(
+                synchronised_datetime, inclusive=True
+            )
+            if latest_plain_labels.get(label.get_label()) is label
+            and label.get_active()
+        )
 
-        return active_labels
+        return new_labels
 
     def get_labels(self, active=None, labels_only=False, label_type='all'):
         """Returns a list of the active/inactive Label Annotations.
@@ -342,20 +792,18 @@ class Metadata:
         active = true - filter for active
         If label_type is set, then filter for plain, hash(#) or address(@) labels
         """
-        label_list = []
-        label_set = set()
-        # Read through labels in reverse order and take the latest one for
-        # each label.
-        for anno in reversed(self.labels):
-            if anno.get_label(label_types=[label_type]) not in label_set:
-                label_list.append(anno)
-                label_set.add(anno.get_label())
-
-        # If not active then filter any inactive labels
-        if active is True:
-            for label in reversed(label_list):
-                if label.get_active() is False:
-                    label_list.remove(label)
+        if label_type == 'all':
+            latest_labels = self._latest_labels
+        else:
+            latest_labels = self._latest_labels_by_type.get(label_type, {})
+
+        # The latest labels are returned with the most recently applied first.
+        # If active is set then filter any inactive labels.
+        label_list = [
+            label
+            for label in reversed(latest_labels.values())
+            if active is not True or label.get_active()
+        ]
 
         if labels_only:
             return_dict = {}
@@ -366,31 +814,49 @@ class Metadata:
 
         return return_dict
 
-    def get_json_schema(self):
+    def get_label_annotations(self) -> List['LabelAnnotation']:
+        """Returns the latest version of each label (as LabelAnnotation objects)
+        with the most recently applied first.
+        """
+        return list(reversed(self._latest_labels.values()))
+
+    def _get_schema_labels(
+        self, inherited_labels: Optional[List['LabelAnnotation']] = None
+    ) -> Dict[str, Any]:
+        """Returns the active labels (label: value) for the json schema.
+        Any inherited labels (e.g. the dataset labels for a version, as returned by
+        get_label_annotations()) are applied, in order, after the metadata's own.
+        """
+        if not inherited_labels:
+            return self.get_labels(active=True, labels_only=True)
+
+        latest_labels = dict(self._latest_labels)
+        for label in inherited_labels:
+            latest_labels.pop(label.get_label(), None)
+            latest_labels[label.get_label()] = label
+        return {
+            label.get_label(): label.get_value()
+            for label in reversed(latest_labels.values())
+            if label.get_active()
+        }
+
+    def get_json_schema(
+        self, inherited_labels: Optional[List['LabelAnnotation']] = None
+    ):
         """Returns the latest complete FieldsDescriptor and labels as a dict
         of the json schema as defined in https://json-schema.org/.
+
+        If inherited_labels are provided (e.g. the dataset labels when this is
+        version metadata) they are included in the schema labels as if they had
+        been added to the metadata.
         """
 
-        # Process all FieldDescriptor Annotations in the Annotations list in
-        # order to retrieve all of the fields in the dataset. Add these to a
-        # single new FieldDescriptor that will have compilation of all fields.
-        # We can then extract the active fields from the final compiled
-        # FieldDescriptor to use in the json schema output.
-        comp_descriptor = FieldsDescriptorAnnotation()
-        for annotation in self.annotations:
-            if annotation.get_type() in [
-                'FieldsDescriptorAnnotation',
-                'ServiceExecutionAnnotation',
-            ]:
-                # Allow for validation errors in old field descriptors.
-                try:
-                    comp_descriptor.add_fields(annotation.get_fields())
-                except AnnotationValidationError:
-                    pass
+        # The compiled fields hold all of the fields in the dataset.
+        # We extract the active fields to use in the json schema output.
         fields = {}
         required = []
 
-        for prop, value in comp_descriptor.get_fields(False).items():
+        for prop, value in self._get_compiled_fields().get_fields(False).items():
             fields[prop] = {'type': value['type'], 'description': value['description']}
             if value['required']:
                 required.append(prop)
@@ -404,7 +870,7 @@ class Metadata:
             'type': 'object',
             'fields': fields,
             'required': required,
-            'labels': self.get_labels(active=True, labels_only=True),
+            'labels': self._get_schema_labels(inherited_labels),
         }
 
         return schema
@@ -414,44 +880,196 @@ class Metadata:
         schema as defined in https://json-schema.org/.
         """
 
-        # Process all FieldDescriptor Annotations in the Annotations list in
-        # order to retrieve all of the fields in the dataset. Add these to a
-        # single new FieldDescriptor that will have compilation of all fields.
+        # The fields are compiled as the annotations are added so we only need
+        # to take a copy (so the caller cannot change the compiled fields).
+        compiled = self._get_compiled_fields().to_dict()
+        compiled['fields'] = copy.deepcopy(compiled['fields'])
+        return compiled
 
-        comp_descriptor = FieldsDescriptorAnnotation()
-        for annotation in self.annotations:
-            if annotation.get_type() in [
-                'FieldsDescriptorAnnotation',
-                'ServiceExecutionAnnotation',
-            ]:
-                # Allow for validation errors in old field descriptors.
-                try:
-                    comp_descriptor.add_fields(annotation.get_fields())
-                except AnnotationValidationError:
-                    pass
-
-        return comp_descriptor.to_dict()
-
-    def to_dict(self):
-        """Return principle data items in the form of a dictionary"""
-        return {
+    def _build_dict(
+        self,
+        annotations: Any,
+        labels: Any,
+        service_parameters_table: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        """Build the dictionary form of the metadata with the given annotations
+        and labels (and service parameters table for compact metadata).
+        """
+        output_dict = {
             "dataset_name": self.dataset_name,
             "dataset_id": self.dataset_uuid,
             "description": self.description,
-            "created": self.created.isoformat(),
-            "last_updated": self.last_updated.isoformat(),
+            "created": _format_timestamp(self.created),
+            "last_updated": _format_timestamp(self.last_updated),
             "created_by": self.created_by,
             "metadata_version": self.metadata_version,
             "dataset_version": self.dataset_version,
-            "annotations": [anno.to_dict() for anno in self.annotations],
-            "labels": [anno.to_dict() for anno in self.labels],
-            "synchronised_datetime": self.synchronised_datetime.isoformat(),
+            "annotations": annotations,
+            "labels": labels,
+            "synchronised_datetime": _format_timestamp(self.synchronised_datetime),
+        }
+        if service_parameters_table is not None:
+            output_dict["service_parameters_table"] = service_parameters_table
+        return output_dict
+
+    def _get_compact_annotations(self) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """Return the annotations in dictionary form with the service parameters
+        replaced by a reference (their hash) and the table of the referenced
+        service parameters.
+        """
+        known_hashes = {
+            id(service_parameters): parameters_hash
+            for parameters_hash, service_parameters in (
+                self._service_parameters_table.items()
+            )
         }
+        service_parameters_table = {}
+        annotations = []
+        for anno in self._annotations:
+            anno_dict = _get_annotation_dict(anno)
+            if _get_annotation_type(anno) == 'ServiceExecutionAnnotation':
+                service_parameters = anno_dict.get('service_parameters') or {}
+                parameters_hash = known_hashes.get(
+                    id(service_parameters)
+                ) or get_service_parameters_hash(service_parameters)
+                service_parameters_table[parameters_hash] = service_parameters
+                anno_dict = {
+                    key: value
+                    for key, value in anno_dict.items()
+                    if key != 'service_parameters'
+                }
+                anno_dict['service_parameters_ref'] = parameters_hash
+            annotations.append(anno_dict)
+        return annotations, service_parameters_table
+
+    def to_dict(self, compact: bool = False):
+        """Return principle data items in the form of a dictionary.
+
+        If compact is set, the service parameters of ServiceExecution annotations
+        are held once (in a "service_parameters_table" indexed by their hash) and
+        the annotations refer to them by their hash ("service_parameters_ref").
+        Compact metadata can be loaded by Metadata(**metadata_dict) and
+        Metadata.from_dict() but not by older versions of this package.
+        """
+        labels = [anno.to_dict() for anno in self.labels]
+        if compact:
+            annotations, service_parameters_table = self._get_compact_annotations()
+            return self._build_dict(annotations, labels, service_parameters_table)
+        return self._build_dict(
+            [_get_annotation_dict(anno) for anno in self._annotations], labels
+        )
 
-    def to_json(self):
-        """Serialize class to JSON"""
-        output_dict = self.to_dict()
-        return json.dumps(output_dict)
+    @classmethod
+    def from_json(cls, data: Union[str, bytes], trusted: bool = False):
+        """Create a Metadata object from the JSON returned by to_json(), which
+        may be compressed (the codec is detected). See from_dict() for trusted.
+        """
+        return cls.from_dict(json.loads(decode_metadata_json(data)), trusted)
+
+    def to_canonical_json(self) -> str:
+        """Return the canonical JSON of the metadata (see get_canonical_json)."""
+        return get_canonical_json(self.to_dict())
+
+    def get_content_hash(self) -> str:
+        """Return a hash of the content of the metadata, e.g. to use as an ETag.
+        Equal metadata (in any serialised form) has the same hash. Annotations
+        are hashed in the (normalised) form they serialise to, which is the same
+        however the metadata was loaded (see from_dict) and does not change when
+        an annotation held in its dictionary form is created.
+
+        The hash combines the canonical JSON of the metadata's own items with a
+        chain of hashes of the annotations and one of the labels. As annotations
+        and labels are only ever appended, the chains are brought up to date with
+        any added since the hash was last calculated rather than re-calculated
+        (unless an annotation or label in them has changed).
+        """
+        self._discard_changed_state()
+        for anno in self._annotations[self._hashed_annotations_count :]:
+            self._annotations_hash = _chain_hash(
+                self._annotations_hash, _get_annotation_dict(anno)
+            )
+        self._hashed_annotations_count = len(self._annotations)
+        for label in self.labels[self._hashed_labels_count :]:
+            self._labels_hash = _chain_hash(self._labels_hash, label.to_dict())
+        self._hashed_labels_count = len(self.labels)
+
+        header = get_canonical_json(self._build_dict(None, None))
+        return hashlib.sha256(
+            '\n'.join([header, self._annotations_hash, self._labels_hash]).encode(
+                'utf8'
+            )
+        ).hexdigest()
+
+    def to_json(self, compact: bool = False, codec: Optional[str] = None):
+        """Serialize class to JSON.
+        The (cached) JSON of each annotation and label is spliced into the output
+        rather than encoding the whole history again. The result is the same as
+        json.dumps(self.to_dict(compact)).
+
+        If a codec ('zlib' or 'gzip') is given the JSON is compressed and returned
+        as bytes (see encode_metadata_json).
+        """
+        if codec:
+            return encode_metadata_json(self.to_json(compact), codec)
+        if compact:
+            return json.dumps(self.to_dict(compact=True))
+
+        fragments = {
+            "annotations": '['
+            + ', '.join(_get_annotation_json(anno) for anno in self._annotations)
+            + ']',
+            "labels": '[' + ', '.join(anno.to_json() for anno in self.labels) + ']',
+        }
+        output_dict = self._build_dict(None, None)
+        return (
+            '{'
+            + ', '.join(
+                (
+                    f'{json.dumps(key)}: {fragments[key]}'
+                    if key in fragments
+                    else f'{json.dumps(key)}: {json.dumps(value)}'
+                )
+                for key, value in output_dict.items()
+            )
+            + '}'
+        )
+
+
+class _Field:
+    """A compact record of a field in a FieldsDescriptorAnnotation.
+    Its dictionary form has the structure of FIELD_DICT.
+    """
+
+    __slots__ = ('type', 'description', 'required', 'active')
+
+    def __init__(
+        self,
+        prop_type: str = '',
+        description: str = '',
+        required: bool = False,
+        active: bool = False,
+    ):
+        self.type = prop_type
+        self.description = description
+        self.required = required
+        self.active = active
+
+    @classmethod
+    def from_dict(cls, field_dict: Dict[str, Any]):
+        return cls(
+            field_dict.get('type', FIELD_DICT['type']),
+            field_dict.get('description', FIELD_DICT['description']),
+            field_dict.get('required', FIELD_DICT['required']),
+            field_dict.get('active', FIELD_DICT['active']),
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'type': self.type,
+            'description': self.description,
+            'required': self.required,
+            'active': self.active,
+        }
 
 
 class Annotation(ABC):
@@ -461,12 +1079,54 @@ class Annotation(ABC):
     Purpose: Annotations can be added to Metadata. They are defined as classes
     so that they can have both fixed data and methods that work with the data.
 
+    Annotations (and their fields) use slots rather than a per-instance
+    dictionary as many annotations can be held in memory.
     """
 
+    __slots__ = ('created', 'annotation_version', '_dict', '_json', '_revision')
+
     @abstractmethod
     def __init__(self):
-        self.created = datetime.datetime.utcnow()
+        self.created = _now()
+        self.annotation_version = get_annotation_version()
+        # The cached dictionary and JSON forms of the annotation
+        self._dict: Optional[Dict[str, Any]] = None
+        self._json: Optional[str] = None
+        # The annotation revision of the last change (see _reset_cache)
+        self._revision = 0
+
+    @classmethod
+    def from_dict(cls, annotation_dict: Dict[str, Any]):
+        """Re-create an annotation from the dictionary form returned by to_dict()
+        without validating or copying it. This is only used for trusted input,
+        i.e. annotations that were validated when they were created.
+        """
+        annotation = cls.__new__(cls)
+        annotation.load_dict(annotation_dict)
+        # Creating the annotation from its dictionary form does not change it.
+        annotation._revision = 0
+        return annotation
+
+    def load_dict(self, annotation_dict: Dict[str, Any]):
+        """Set the annotation's data items from its dictionary form."""
+        # As when annotations are transferred to a new metadata instance,
+        # the original created datetime is kept but the version is reset.
+        if annotation_dict.get('created'):
+            self.set_created(annotation_dict['created'])
+        else:
+            self.created = _now()
         self.annotation_version = get_annotation_version()
+        self._reset_cache()
+
+    def _reset_cache(self):
+        """Discard the cached dictionary and JSON forms after a change, and
+        record the change (see Metadata._discard_changed_state).
+        """
+        global _annotation_revision  # pylint: disable=global-statement
+        _annotation_revision += 1
+        self._dict = None
+        self._json = None
+        self._revision = _annotation_revision
 
     def get_type(self):
         return self.__class__.__name__
@@ -475,19 +1135,34 @@ class Annotation(ABC):
         """This used only when transferring existing annotations to a new
         metadata instance.
         """
-        self.created = datetime.datetime.fromisoformat(created)
+        self.created = _parse_timestamp(created)
+        self._reset_cache()
 
-    def to_dict(self):
-        """Return principle data items in the form of a dictionary"""
+    def get_created(self) -> str:
+        return _format_timestamp(self.created)
+
+    def _build_dict(self):
+        """Build the dictionary form of the annotation"""
         return {
             "type": self.__class__.__name__,
-            "created": self.created.isoformat(),
+            "created": _format_timestamp(self.created),
             "annotation_version": self.annotation_version,
         }
 
+    def to_dict(self):
+        """Return principle data items in the form of a dictionary.
+        Annotations are not expected to change once they have been added to the
+        metadata, so the dictionary is built once and a (shallow) copy returned.
+        """
+        if self._dict is None:
+            self._dict = self._build_dict()
+        return dict(self._dict)
+
     def to_json(self):
-        """Serialize class to JSON"""
-        return json.dumps(self.to_dict())
+        """Serialize class to JSON (this is also built once)"""
+        if self._json is None:
+            self._json = json.dumps(self.to_dict())
+        return self._json
 
 
 class PropertyChangeAnnotation(Annotation):
@@ -497,8 +1172,7 @@ class PropertyChangeAnnotation(Annotation):
 
     """
 
-    # meta_property: str = ''
-    # previous_value: str = ''
+    __slots__ = ('meta_property', 'previous_value')
 
     def __init__(self, meta_property: str, previous_value: str):
         assert property
@@ -506,13 +1180,19 @@ class PropertyChangeAnnotation(Annotation):
         self.previous_value = previous_value
         super().__init__()
 
-    def to_dict(self):
-        """Return principle data items in the form of a dictionary"""
+    def load_dict(self, annotation_dict: Dict[str, Any]):
+        """Set the annotation's data items from its dictionary form."""
+        super().load_dict(annotation_dict)
+        self.meta_property = annotation_dict['meta_property']
+        self.previous_value = annotation_dict['previous_value']
+
+    def _build_dict(self):
+        """Build the dictionary form of the annotation"""
         output_dict = {
             "meta_property": self.meta_property,
             "previous_value": self.previous_value,
         }
-        return {**super().to_dict(), **output_dict}
+        return {**super()._build_dict(), **output_dict}
 
 
 class LabelAnnotation(Annotation):
@@ -533,6 +1213,8 @@ class LabelAnnotation(Annotation):
 
     """
 
+    __slots__ = ('label', 'value', 'active', 'reference')
+
     def __init__(
         self, label: str, value: str = None, active: bool = True, reference: str = None
     ):
@@ -543,6 +1225,14 @@ class LabelAnnotation(Annotation):
         self.reference = reference
         super().__init__()
 
+    def load_dict(self, annotation_dict: Dict[str, Any]):
+        """Set the annotation's data items from its dictionary form."""
+        super().load_dict(annotation_dict)
+        self.label = annotation_dict['label'].lower()
+        self.value = annotation_dict.get('value')
+        self.active = annotation_dict.get('active', True)
+        self.reference = annotation_dict.get('reference')
+
     def validate(self, label: str, value: str = None):
         """Validate main data items"""
 
@@ -568,6 +1258,14 @@ class LabelAnnotation(Annotation):
         elif 'plain' in label_types and self.label[0] not in ['#', '@']:
             return self.label
 
+    def get_label_type(self):
+        """Returns the implicit type of the label (plain, hash or address)"""
+        if self.label[0] == '#':
+            return 'hash'
+        if self.label[0] == '@':
+            return 'address'
+        return 'plain'
+
     def get_value(self):
         return self.value
 
@@ -577,10 +1275,10 @@ class LabelAnnotation(Annotation):
     def get_reference(self):
         return self.reference
 
-    def to_dict(self):
-        """Return principle data items in the form of a dictionary"""
+    def _build_dict(self):
+        """Build the dictionary form of the annotation"""
         return {
-            **super().to_dict(),
+            **super()._build_dict(),
             "label": self.label,
             "value": self.value,
             "active": self.active,
@@ -588,6 +1286,87 @@ class LabelAnnotation(Annotation):
         }
 
 
+class FieldExpression:
+    """A field expression (a Jinja2 template, see FieldsDescriptorAnnotation.add_field)
+    that is compiled once so that it can be rendered with different variables.
+
+    Rendering gives the same result as decoder.decode() with the "jinja2_3_0"
+    template engine (in im-data-manager-job-decoder 2.x). This is a copy of the
+    decoder's rendering, which is no longer a dependency, so it will not follow
+    any future changes to the decoder.
+    """
+
+    __slots__ = ('expression', '_template', '_error')
+
+    # The environment used by the decoder's "jinja2_3_0" template engine.
+    _environment = jinja2.Environment(undefined=jinja2.DebugUndefined)
+
+    def __init__(self, expression: str, subject: str = 'field-expression'):
+        assert expression
+        self.expression = expression
+        self._template: Optional[jinja2.Template] = None
+        self._error: Optional[str] = None
+        try:
+            self._template = self._environment.from_string(expression)
+        except jinja2.TemplateSyntaxError as ex:
+            self._error = f'TemplateSyntaxError with {subject}: {ex}'
+
+    def __str__(self):
+        return self.expression
+
+    def render(
+        self, variables: Optional[Dict[str, Any]], subject: str = 'field-expression'
+    ) -> Tuple[str, bool]:
+        """Return the rendered expression and True, or an error message and False
+        if the expression cannot be rendered with the variables.
+        """
+        # If there are no variables the expression is returned (as it is).
+        if variables is None:
+            return self.expression, True
+        if self._template is None:
+            return self._error, False
+
+        # The rendered text, when stripped of whitespace, must not be empty and
+        # must not contain any undefined variables.
+        rendered_text = self._template.render(variables).strip()
+        if len(rendered_text) == 0:
+            return f'Rendered text for {subject} is blank', False
+        undefined = find_undeclared_variables(self._environment.parse(rendered_text))
+        if undefined:
+            msg = f'Undefined template variables for {subject}:'
+            for variable in undefined:
+                msg += f' {variable},'
+            return msg[:-1], False
+
+        return rendered_text, True
+
+
+@functools.lru_cache(maxsize=_FIELD_EXPRESSION_CACHE_SIZE)
+def get_field_expression(expression: str) -> FieldExpression:
+    """Return the compiled FieldExpression for the expression text.
+    Expressions are compiled once, and the cache's hits and misses are available
+    from get_field_expression.cache_info().
+    """
+    return FieldExpression(expression)
+
+
+def render_field_expressions(
+    expressions: Dict[str, Union[str, FieldExpression]],
+    variables: Optional[Dict[str, Any]],
+) -> Dict[str, Tuple[str, bool]]:
+    """Render a dictionary of field expressions (the text or compiled expression
+    indexed by field name) against the same variables, in one pass.
+    The result is the rendered text (or an error message) and whether it could be
+    rendered, indexed by field name.
+    """
+    rendered = {}
+    for field_name, expression in expressions.items():
+        if not isinstance(expression, FieldExpression):
+            expression = get_field_expression(expression)
+        rendered[field_name] = expression.render(variables)
+    return rendered
+
+
 class FieldsDescriptorAnnotation(Annotation):
     """Class FieldsDescriptorAnnotation
 
@@ -596,8 +1375,12 @@ class FieldsDescriptorAnnotation(Annotation):
     This is expected to be of the format:
     { "name": string, "type": string, "description": string, "active": boolean}
 
+    The fields are held as compact records and returned in dict format.
+
     """
 
+    __slots__ = ('origin', 'description', 'spec', 'fields')
+
     def __init__(
         self,
         origin: str = '',
@@ -618,6 +1401,17 @@ class FieldsDescriptorAnnotation(Annotation):
             self.fields = {}
         super().__init__()
 
+    def load_dict(self, annotation_dict: Dict[str, Any]):
+        """Set the annotation's data items from its dictionary form."""
+        super().load_dict(annotation_dict)
+        self.origin = annotation_dict.get('origin', '')
+        self.description = annotation_dict.get('description', '')
+        self.spec = None
+        self.fields = {
+            field_name: _Field.from_dict(field_dict)
+            for field_name, field_dict in (annotation_dict.get('fields') or {}).items()
+        }
+
     def get_origin(self):
         return self.origin
 
@@ -630,6 +1424,7 @@ class FieldsDescriptorAnnotation(Annotation):
     def set_origin(self, origin):
         self.validate_origin(origin)
         self.origin = origin
+        self._reset_cache()
 
     def get_description(self):
         return self.description
@@ -644,6 +1439,7 @@ class FieldsDescriptorAnnotation(Annotation):
 
     def set_description(self, description):
         self.description = description
+        self._reset_cache()
 
     def validate_field(
         self, field_name: str, prop_type: str = None, description: str = None
@@ -651,9 +1447,7 @@ class FieldsDescriptorAnnotation(Annotation):
         """Validate an additions/updates to a field"""
 
         # field_name
-        if not re.match(
-            ANNOTATION_ERRORS['FieldsDescriptorAnnotation']['3']['regex'], field_name
-        ):
+        if not _FIELD_NAME_PATTERN.match(field_name):
             raise AnnotationValidationError(
                 'FieldsDescriptorAnnotation', '3', 'field_name', field_name
             )
@@ -670,10 +1464,7 @@ class FieldsDescriptorAnnotation(Annotation):
 
         # description can be omitted but if it's there it must be < 255
         if description:
-            if not re.match(
-                ANNOTATION_ERRORS['FieldsDescriptorAnnotation']['5']['regex'],
-                description,
-            ):
+            if not _FIELD_DESCRIPTION_PATTERN.match(description):
                 raise AnnotationValidationError(
                     'FieldsDescriptorAnnotation', '5', 'description', field_name
                 )
@@ -685,7 +1476,7 @@ class FieldsDescriptorAnnotation(Annotation):
         active: bool = True,
         prop_type: str = None,
         description: str = None,
-        expression: str = None,
+        expression: Union[str, FieldExpression] = None,
         required: bool = None,
         job_spec: Optional[Dict[str, Any]] = None,
     ) -> None:
@@ -694,6 +1485,7 @@ class FieldsDescriptorAnnotation(Annotation):
         # If an expression is provided it is assumed to be a jinja2 expression
         # that's expanded using the Job's original variables (in the specification).
         # The field name is then replaced using the result of the expression.
+        # The expression may have already been compiled (as a FieldExpression).
         rendered_field_name: str = field_name
         if expression:
             basic_logger.info(
@@ -704,15 +1496,12 @@ class FieldsDescriptorAnnotation(Annotation):
                 raise RuntimeError(
                     f'Field "{field_name}" with expression but no job_spec'
                 )
-            # Extract variables from the Job spec using our decoder
-            # and the "jinja2_3_0" templating engine (that's all that's available atm).
+            # Extract variables from the Job spec and render the (compiled)
+            # expression as the decoder's "jinja2_3_0" templating engine would.
             variables: Dict[str, str] = job_spec.get('variables', {})
-            rendered_field_name, success = decoder.decode(
-                expression,
-                variables,
-                'field-expression',
-                decoder.TextEncoding.JINJA2_3_0,
-            )
+            rendered_field_name, success = render_field_expressions(
+                {field_name: expression}, variables
+            )[field_name]
             if not success:
                 # Failed to render the expression.
                 # Do not add this field.
@@ -721,66 +1510,133 @@ class FieldsDescriptorAnnotation(Annotation):
                 )
                 return
 
+        self._set_field(rendered_field_name, active, prop_type, description, required)
+
+    def _set_field(
+        self,
+        field_name: str,
+        active: bool,
+        prop_type: Optional[str],
+        description: Optional[str],
+        required: Optional[bool],
+    ) -> None:
+        """Add (or update) a field, once any expression has been rendered"""
+
         # validate the field data
-        self.validate_field(rendered_field_name, prop_type, description)
+        self.validate_field(field_name, prop_type, description)
 
         # Add to list
-        if rendered_field_name not in self.fields:
-            # Note that this has to be copied in,
-            # or it will reference the same dictionary.
-            self.fields[rendered_field_name] = copy.deepcopy(FIELD_DICT)
+        field = self.fields.get(field_name)
+        if field is None:
+            field = _Field()
+            self.fields[field_name] = field
 
-        self.fields[rendered_field_name]['active'] = active
+        field.active = active
 
         if prop_type:
-            self.fields[rendered_field_name]['type'] = prop_type.lower()
+            field.type = prop_type.lower()
         if description:
-            self.fields[rendered_field_name]['description'] = description
+            field.description = description
         if required:
-            self.fields[rendered_field_name]['required'] = required
+            field.required = required
+        self._reset_cache()
 
     def get_property(self, field_name: str):
         """Get a property from the fields list identified by the name."""
-        return self.fields[field_name]
+        return self.fields[field_name].to_dict()
 
     def add_fields(self, new_fields: dict, job_spec: Optional[dict] = None):
         """Add a dictionary of additions/updates to the fields list
         fields. Each field must have a 'type'.
+
+        Field expressions (see add_field) are rendered against the Job's
+        variables in one pass.
         """
 
+        expressions = {
+            prop: values['expression']
+            for prop, values in new_fields.items()
+            if values.get('expression')
+        }
+        rendered = {}
+        if expressions:
+            if not job_spec:
+                raise RuntimeError(
+                    f'Field "{next(iter(expressions))}" with expression but no job_spec'
+                )
+            basic_logger.info('Handling expressions for %s', list(expressions))
+            rendered = render_field_expressions(
+                expressions, job_spec.get('variables', {})
+            )
+
         for prop, values in new_fields.items():
             # unpack the individual lines for processing, adding optional fields.
             if 'type' not in values:
                 raise RuntimeError(f'Property "{prop}" has no "type"')
-            self.add_field(
-                field_name=prop,
-                active=values.get('active', True),
-                prop_type=values['type'],
-                description=values.get('description'),
-                expression=values.get('expression'),
-                required=values.get('required', False),
-                job_spec=job_spec,
+            field_name = prop
+            if prop in rendered:
+                field_name, success = rendered[prop]
+                if not success:
+                    # Failed to render the expression.
+                    # Do not add this field.
+                    basic_logger.warning(
+                        'Expression failure for "%s" (%s)', prop, field_name
+                    )
+                    continue
+            self._set_field(
+                field_name,
+                values.get('active', True),
+                values['type'],
+                values.get('description'),
+                values.get('required', False),
             )
 
+    def merge_fields(self, fields: Dict[str, Dict[str, Any]]):
+        """Merge the active fields of another FieldsDescriptor (in the dictionary
+        form returned by get_fields) into the fields list. This has the same effect
+        as add_fields with the other FieldsDescriptor's active fields.
+        """
+        try:
+            for field_name, values in fields.items():
+                if not values.get('active'):
+                    continue
+                prop_type = values.get('type')
+                description = values.get('description')
+                self.validate_field(field_name, prop_type, description)
+
+                field = self.fields.get(field_name)
+                if field is None:
+                    field = _Field()
+                    self.fields[field_name] = field
+                field.active = True
+                if prop_type:
+                    field.type = prop_type.lower()
+                if description:
+                    field.description = description
+                if values.get('required'):
+                    field.required = True
+        finally:
+            self._reset_cache()
+
     def get_fields(self, get_all: bool = False):
         """Get (all/only active) fields from the property list in dict format."""
         if get_all:
-            return self.fields
+            return {prop: value.to_dict() for prop, value in self.fields.items()}
         else:
             # Return active fields only
             active_fields = {}
             for prop, value in self.fields.items():
-                if value['active']:
-                    active_fields[prop] = value
+                if value.active:
+                    active_fields[prop] = value.to_dict()
             return active_fields
 
-    def to_dict(self):
-        """Return principle data items in the form of a dictionary"""
+    def _build_dict(self):
+        """Build the dictionary form of the annotation"""
         return {
-            **super().to_dict(),
+            **super()._build_dict(),
             "origin": self.origin,
             "description": self.description,
-            "fields": self.fields,
+            "fields": self.get_fields(True),
         }
 
 
@@ -791,6 +1647,15 @@ class ServiceExecutionAnnotation(FieldsDescriptorAnnotation):
 
     """
 
+    __slots__ = (
+        'service',
+        'service_version',
+        'service_user',
+        'service_name',
+        'service_ref',
+        'service_parameters',
+    )
+
     def __init__(
         self,
         service: str,
@@ -818,7 +1683,19 @@ class ServiceExecutionAnnotation(FieldsDescriptorAnnotation):
             self.service_parameters = copy.deepcopy(service_parameters)
         else:
             self.service_parameters = {}
-        super().__init__(origin, description, fields, service_parameters)
+        super().__init__(origin, description, fields, self.service_parameters)
+
+    def load_dict(self, annotation_dict: Dict[str, Any]):
+        """Set the annotation's data items from its dictionary form.
+        Note that the service parameters are not copied.
+        """
+        super().load_dict(annotation_dict)
+        self.service = annotation_dict['service']
+        self.service_version = annotation_dict['service_version']
+        self.service_user = annotation_dict['service_user']
+        self.service_name = annotation_dict['service_name']
+        self.service_ref = annotation_dict['service_ref']
+        self.service_parameters = annotation_dict.get('service_parameters') or {}
 
     def get_service(self):
         return self.service
@@ -881,14 +1758,15 @@ class ServiceExecutionAnnotation(FieldsDescriptorAnnotation):
 
     def set_service_parameters(self, service_parameters: dict):
         self.service_parameters = copy.deepcopy(service_parameters)
+        self._reset_cache()
 
     def parameters_to_yaml(self):
         return yaml.dump(self.service_parameters)
 
-    def to_dict(self):
-        """Return principle data items in the form of a dictionary"""
+    def _build_dict(self):
+        """Build the dictionary form of the annotation"""
         return {
-            **super().to_dict(),
+            **super()._build_dict(),
             "service": self.service,
             "service_version": self.service_version,
             "service_user": self.service_user,
@@ -898,6 +1776,15 @@ class ServiceExecutionAnnotation(FieldsDescriptorAnnotation):
         }
 
 
+# The annotation classes that can be re-created from their dictionary form,
+# indexed by the annotation type.
+_ANNOTATION_CLASSES = {
+    'PropertyChangeAnnotation': PropertyChangeAnnotation,
+    'FieldsDescriptorAnnotation': FieldsDescriptorAnnotation,
+    'ServiceExecutionAnnotation': ServiceExecutionAnnotation,
+}
+
+
 if __name__ == "__main__":
     print('Data Manager Metadata (v%s)', _METADATA_VERSION)
     print('Data Manager Annotation (v%s)', _ANNOTATION_VERSION)
@@ -13,7 +13,8 @@ Examples:
 
     python md_manage.py lb 'label' -lv='blob' -af=test/output
     - create a label annotation in an annotations.json file placed in test/output. Running the
-    command again will create a second annotation in the same file (i.e. a list of two).
+    command again will append a second annotation to the same file (a line of JSON for each
+    annotation, i.e. JSON Lines).
 
     python md_manage.py fd -fo='squonk2-job' -fp='minimizedAffinity,number,Binding affinity \
                         predicted by smina using the vinardo scoring function,true,true' \
@@ -26,19 +27,30 @@ Examples:
                         -fd='Run smina docking' -af=test/output
     - create a service execution annotation in an annotations.json file placed in test/output.
 
+    python md_manage.py compact test/output/results.sdf
+    - validate the annotations in the annotations file of test/output/results.sdf and rewrite it.
+
 
 See the README for more details.
 
 """
 
 import argparse
+import contextlib
 import os
 import sys
 import json
+import uuid
 from yaml import safe_load
+
+try:
+    import fcntl
+except ImportError:  # fcntl is only available on POSIX
+    fcntl = None  # pylint: disable=invalid-name
 from data_manager_metadata.metadata import (
     FIELD_DICT,
     get_annotation_filename,
+    load_annotations_json,
     Metadata,
     LabelAnnotation,
     FieldsDescriptorAnnotation,
@@ -160,6 +172,123 @@ def add_service_execution_annotation_args(c_parser):
     c_parser.set_defaults(func=create_service_execution_annotation)
 
 
+def add_compact_args(c_parser):
+    """Add arguments for compacting an annotations file"""
+    c_parser.add_argument(
+        'filepath',
+        type=str,
+        help='Filepath to a (results) file that has an annotations file - Required',
+    )
+    c_parser.add_argument(
+        '--json-list',
+        action='store_true',
+        help='When set, the annotations are written as a JSON list rather than '
+        'JSON Lines',
+    )
+
+    c_parser.set_defaults(func=None)
+
+
+@contextlib.contextmanager
+def _locked_annotations_file(annotations_path: str, mode: str):
+    """Open an annotations file holding an (advisory) lock on the file itself, so
+    that concurrent invocations do not interleave. The file can be replaced when it
+    is compacted, so the lock is taken again if that happened while waiting for it.
+    The file is not locked where fcntl is not available (i.e. not on POSIX).
+    """
+    encoding = None if 'b' in mode else 'utf-8'
+    while True:
+        with open(annotations_path, mode, encoding=encoding) as annotations_file:
+            if fcntl is None:
+                yield annotations_file
+                return
+            fcntl.flock(annotations_file, fcntl.LOCK_EX)
+            if os.path.samestat(
+                os.fstat(annotations_file.fileno()), os.stat(annotations_path)
+            ):
+                yield annotations_file
+                return
+
+
+def _write_annotations_file(annotations_path: str, annotations: list, json_list=False):
+    """Replace the annotations file (atomically) with the annotations
+    in JSON Lines or a JSON list.
+    """
+    tmp_file = f'{annotations_path}.{uuid.uuid4().hex}.tmp'
+    try:
+        with open(tmp_file, 'x', encoding='utf-8') as out_file:
+            if json_list:
+                json.dump(annotations, out_file)
+            else:
+                out_file.writelines(
+                    json.dumps(annotation) + '\n' for annotation in annotations
+                )
+        os.replace(tmp_file, annotations_path)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def _is_json_lines(first_line: bytes) -> bool:
+    """Return True if the first line of an annotations file is a line of JSON
+    Lines (an annotation), rather than the start of a JSON list or of an
+    annotation written over several lines. An empty file is JSON Lines.
+    """
+    if not first_line:
+        return True
+    try:
+        return isinstance(json.loads(first_line), dict)
+    except ValueError:
+        return False
+
+
+def append_annotation(annotations_path: str, annotation) -> None:
+    """Append an annotation to an annotations file, as a line of JSON (JSON Lines).
+    Only the new annotation is written (the existing annotations are not read
+    again) under a lock, so that concurrent invocations do not interleave.
+    An annotations file that is not JSON Lines (a JSON list or annotation) is
+    converted to JSON Lines first.
+    """
+    annotation_line = annotation.to_json().encode('utf-8') + b'\n'
+    with _locked_annotations_file(annotations_path, 'ab+') as annotations_file:
+        annotations_file.seek(0)
+        if not _is_json_lines(annotations_file.readline()):
+            annotations_file.seek(0)
+            annotations = load_annotations_json(annotations_file.read().decode('utf-8'))
+            annotations.append(annotation.to_dict())
+            _write_annotations_file(annotations_path, annotations)
+            return
+        # The last line may not have been terminated
+        if annotations_file.seek(0, os.SEEK_END):
+            annotations_file.seek(-1, os.SEEK_END)
+            if annotations_file.read(1) != b'\n':
+                annotation_line = b'\n' + annotation_line
+        annotations_file.write(annotation_line)
+
+
+def compact_annotations(annotations_path: str, json_list=False) -> int:
+    """Validate the annotations in an annotations file and rewrite it (atomically)
+    in JSON Lines or as a JSON list. Returns the number of annotations.
+    """
+    with _locked_annotations_file(annotations_path, 'rt') as existing_annotations:
+        annotation_rows = load_annotations_json(existing_annotations.read())
+
+        # Create a metadata class to act as a holder (and validator) for annotations.
+        # Labels are held separately, so each annotation is re-created (validated)
+        # in turn to keep the order of the file.
+        meta_holder = Metadata('dm', 'dm', 'dm', 'dm')
+        annotations = []
+        for annotation_row in annotation_rows:
+            if annotation_row.get('type') == 'LabelAnnotation':
+                meta_holder.add_labels([annotation_row])
+                annotations.append(meta_holder.labels[-1].to_dict())
+            else:
+                meta_holder.add_annotations(annotation_row)
+                annotations.append(meta_holder.get_annotation(-1).to_dict())
+        _write_annotations_file(annotations_path, annotations, json_list)
+    return len(annotations)
+
+
 def create_label_annotation(c_args):
     """Add a label annotation to the annotation json file"""
     return LabelAnnotation(c_args.label, c_args.value, c_args.make_inactive)
@@ -300,8 +429,8 @@ if __name__ == '__main__':
     #
     # parameters are specific to the requested annotation.
     # A filepath for an annotations file can be optionally provided.
-    # If the annotations file already exists, then the annotation will be added to it
-    # in the form of an array.
+    # If the annotations file already exists, then the annotation will be appended
+    # to it (as a line of JSON). The compact command validates and rewrites the file.
     parser = argparse.ArgumentParser('Metadata Annotation Generator')
     subparsers = parser.add_subparsers(help='Please choose an annotation type')
 
@@ -318,6 +447,10 @@ if __name__ == '__main__':
     add_fields_descriptor_annotation_args(parser_se)
     add_service_execution_annotation_args(parser_se)
 
+    # Parser for compacting an annotations file
+    parser_compact = subparsers.add_parser('compact', help='Compact annotations file')
+    add_compact_args(parser_compact)
+
     args = parser.parse_args()
     assert args.filepath
     file_name = os.path.basename(args.filepath)
@@ -329,18 +462,12 @@ if __name__ == '__main__':
         os.makedirs(file_dir)
     anno_file = os.path.join(file_dir, annotations_filename)
 
-    # Create a metadata class to act as a holder for annotations
-    meta_holder = Metadata('dm', 'dm', 'dm', 'dm')
-
-    if os.path.isfile(anno_file):
-        # Annotations File already exists - import any annotations and add to the holder
-        with open(anno_file, 'rt', encoding='utf-8') as existing_annotations:
-            meta_holder.add_annotations(existing_annotations.read())
-
-    # Create the new annotation and add to the list
-    anno = args.func(args)
-    meta_holder.add_annotation(anno)
-
-    # Recreate output and write the list of annotations to it.
-    out_file = open(anno_file, "w", encoding="utf-8")
-    json.dump(meta_holder.get_annotations_dict(), out_file)
+    if args.func is None:
+        # Compact the annotations file
+        if not os.path.isfile(anno_file):
+            print('Annotations file does not exist in this location')
+            sys.exit(1)
+        print(f'{compact_annotations(anno_file, args.json_list)} annotations')
+    else:
+        # Create the new annotation and append it to the file
+        append_annotation(anno_file, args.func(args))
@@ -25,13 +25,15 @@ setup(
     keywords='jenkins',
     platforms=['any'],
     # Our modules to package
-    packages=find_packages(exclude=['*.test', '*.test.*', 'test.*', 'test']),
+    packages=find_packages(
+        exclude=['*.test', '*.test.*', 'test.*', 'test', 'benchmarks', 'benchmarks.*']
+    ),
     py_modules=['data_manager_metadata'],
     # Minimum requirements to use the metadata.
     # This is different to the requirements.txt file
     install_requires=[
         'PyYAML>=6.0.1,<7.0',
-        'im-data-manager-job-decoder>=2.1.0,<3.0.0',
+        'Jinja2>=3.0,<4.0',
     ],
     # Supported Python versions
     python_requires='>=3, <4',
@@ -1,4 +1,5 @@
 import unittest
+import asyncio
 import os
 import json
 
@@ -6,6 +7,7 @@ import json
 # from decoder import decoder
 
 from data_manager_metadata.metadata import (
+    Metadata,
     FieldsDescriptorAnnotation,
     ServiceExecutionAnnotation,
     _DEFAULT_SYNC_TIME,
@@ -16,12 +18,25 @@ from data_manager_metadata.data_tier_api import (
     post_version_metadata,
     patch_dataset_metadata,
     get_version_schema,
+    get_version_schemas,
+    get_metadata_etag,
+    get_schema_etag,
+    refresh_version_schema_labels,
     patch_version_metadata,
     get_travelling_metadata,
     patch_travelling_metadata,
     post_travelling_metadata_to_new_dataset,
     post_travelling_metadata_to_existing_dataset,
     create_job_annotations,
+    create_job_annotations_async,
+    create_job_annotations_batch,
+    _write_file,
+    _get_derived_metadata,
+    clear_derived_metadata_cache,
+    get_derived_metadata_cache_metrics,
+    _get_annotation_plan,
+    _create_labels,
+    _create_service_execution,
 )
 
 
@@ -270,11 +285,17 @@ class DataTierTestCase(unittest.TestCase):
         )
 
         print(dataset_metadata)
+        original_dataset_metadata = json.dumps(dataset_metadata)
+        original_version_metadata = json.dumps(version_metadata)
 
         travelling_metadata, travelling_schema = get_travelling_metadata(
             dataset_metadata, version_metadata
         )
 
+        # The stored metadata is not changed
+        self.assertEqual(json.dumps(dataset_metadata), original_dataset_metadata)
+        self.assertEqual(json.dumps(version_metadata), original_version_metadata)
+
         self.assertEqual(len(travelling_metadata['annotations']), 1)
         self.assertEqual(len(travelling_metadata['labels']), 1)
         self.assertEqual(travelling_metadata['dataset_version'], 1)
@@ -370,6 +391,12 @@ class DataTierTestCase(unittest.TestCase):
         self.assertEqual(len(new_schema['fields']), 2)
         self.assertEqual(len(new_schema['required']), 1)
 
+        # The new version has its own copy of the service parameters.
+        new_version['annotations'][0]['service_parameters']['param1'] = 'changed'
+        self.assertEqual(
+            travelling_metadata['annotations'][0]['service_parameters'], params
+        )
+
         print('\nTest 7.1 ok')
 
     def test_08_patch_travelling_metadata_to_existing_dataset(self):
@@ -494,6 +521,420 @@ class DataTierTestCase(unittest.TestCase):
 
         print('\nTest 8.1 ok')
 
+    def test_09_get_version_schemas(self):
+        print('9.1 get_version_schemas')
+
+        dataset_metadata, dummy = post_dataset_metadata(
+            'test dataset',
+            'dataset-0d7ce92a-50ff-42f4-9936-6ccf701938c1',
+            'description of the dataset',
+            'Fred',
+        )
+        fields = {
+            'smiles': {
+                'type': 'string',
+                'description': 'standardized smiles',
+                'required': True,
+                'active': True,
+            }
+        }
+        versions = [
+            post_version_metadata(
+                dataset_metadata,
+                version,
+                annotations=FieldsDescriptorAnnotation(
+                    'Supplier 1', f'Version {version}', fields
+                ).to_dict(),
+            )[0]
+            for version in range(1, 6)
+        ]
+
+        labels_list = [
+            {'type': 'LabelAnnotation', 'label': 'label1', 'value': 'value1'},
+            {'type': 'LabelAnnotation', 'label': 'label2', 'value': 'value2'},
+            {'type': 'LabelAnnotation', 'label': 'label1', 'value': 'value3'},
+            {
+                'type': 'LabelAnnotation',
+                'label': 'label2',
+                'value': 'value2',
+                'active': False,
+            },
+        ]
+        new_dataset_metadata, dummy = patch_dataset_metadata(
+            dataset_metadata, labels=labels_list
+        )
+
+        expected = [
+            get_version_schema(new_dataset_metadata, version) for version in versions
+        ]
+        self.assertEqual(expected[0]['labels'], {'label1': 'value3'})
+        self.assertEqual(get_version_schemas(new_dataset_metadata, versions), expected)
+        self.assertEqual(
+            get_version_schemas(new_dataset_metadata, versions, max_workers=2),
+            expected,
+        )
+        self.assertEqual(get_version_schemas(new_dataset_metadata, []), [])
+
+        print('\nTest 9.1 ok')
+
+    def test_10_refresh_version_schema_labels(self):
+        print('10.1 refresh_version_schema_labels')
+
+        dataset_metadata, dummy = post_dataset_metadata(
+            'test dataset',
+            'dataset-0d7ce92a-50ff-42f4-9936-6ccf701938c1',
+            'description of the dataset',
+            'Fred',
+        )
+        version_metadata, version_schema = post_version_metadata(dataset_metadata, 1)
+
+        labels_list = [
+            {'type': 'LabelAnnotation', 'label': 'label1', 'value': 'value1'},
+            {'type': 'LabelAnnotation', 'label': 'label2', 'value': 'value2'},
+            {'type': 'LabelAnnotation', 'label': 'label3', 'active': False},
+        ]
+        new_dataset_metadata, new_dataset_schema = patch_dataset_metadata(
+            dataset_metadata, labels=labels_list
+        )
+
+        schema, fingerprint = refresh_version_schema_labels(
+            version_schema, new_dataset_schema['labels']
+        )
+        expected = get_version_schema(new_dataset_metadata, version_metadata)
+        self.assertEqual(schema, expected)
+        self.assertEqual(list(schema['labels']), list(expected['labels']))
+        self.assertEqual(len(version_schema['labels']), 0)
+
+        # An unchanged label set skips the work.
+        same_schema, same_fingerprint = refresh_version_schema_labels(
+            schema, new_dataset_schema['labels'], fingerprint
+        )
+        self.assertIs(same_schema, schema)
+        self.assertEqual(same_fingerprint, fingerprint)
+        same_schema, dummy = refresh_version_schema_labels(
+            schema, new_dataset_schema['labels']
+        )
+        self.assertIs(same_schema, schema)
+
+        # A changed label set is refreshed.
+        newer_dataset_metadata, newer_dataset_schema = patch_dataset_metadata(
+            new_dataset_metadata,
+            labels=[{'type': 'LabelAnnotation', 'label': 'label1', 'value': 'new'}],
+        )
+        new_schema, new_fingerprint = refresh_version_schema_labels(
+            schema, newer_dataset_schema['labels'], fingerprint
+        )
+        self.assertNotEqual(new_fingerprint, fingerprint)
+        self.assertEqual(
+            new_schema, get_version_schema(newer_dataset_metadata, version_metadata)
+        )
+
+        print('\nTest 10.1 ok')
+
+    def test_11_etags(self):
+        print('11.1 get_metadata_etag and get_schema_etag')
+
+        dataset_metadata, dataset_schema = post_dataset_metadata(
+            'test dataset',
+            'dataset-0d7ce92a-50ff-42f4-9936-6ccf701938c1',
+            'description of the dataset',
+            'Fred',
+        )
+        metadata_etag = get_metadata_etag(dataset_metadata)
+        schema_etag = get_schema_etag(dataset_schema)
+        self.assertEqual(
+            get_metadata_etag(json.loads(json.dumps(dataset_metadata))), metadata_etag
+        )
+        self.assertEqual(
+            get_schema_etag(dict(reversed(dataset_schema.items()))), schema_etag
+        )
+
+        new_dataset_metadata, new_dataset_schema = patch_dataset_metadata(
+            dataset_metadata,
+            labels=[{'type': 'LabelAnnotation', 'label': 'label1', 'value': 'v1'}],
+        )
+        self.assertNotEqual(get_metadata_etag(new_dataset_metadata), metadata_etag)
+        self.assertNotEqual(get_schema_etag(new_dataset_schema), schema_etag)
+
+        print('\nTest 11.1 ok')
+
+    def test_12_write_file(self):
+        print('12.1 _write_file')
+        out_dir = 'test/output/api/12/'
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        path = os.path.join(out_dir, 'results.schema.json')
+        if os.path.exists(path):
+            os.remove(path)
+
+        self.assertTrue(_write_file(path, b'{"labels": {}}'))
+        # Unchanged content is not written again.
+        self.assertFalse(_write_file(path, b'{"labels": {}}'))
+        self.assertTrue(_write_file(path, b'{"labels": {"a": 1}}'))
+        self.assertTrue(_write_file(path, b'{"labels": {"b": 1}}'))
+        with open(path, 'rb') as written_file:
+            self.assertEqual(written_file.read(), b'{"labels": {"b": 1}}')
+        # No temporary files are left behind.
+        self.assertEqual(os.listdir(out_dir), ['results.schema.json'])
+
+        print('\nTest 12.1 ok')
+
+    def test_13_annotation_plan(self):
+        print('13.1 _get_annotation_plan')
+        output_spec = {
+            'annotation-properties': {
+                'fields-descriptor': {
+                    'origin': 'squonk2-job',
+                    'description': 'Run smina docking',
+                    'fields': {
+                        'minimizedAffinity': {'type': 'number'},
+                        'dynamicField': {
+                            'type': 'string',
+                            'expression': '{{ dynamicFieldName }}',
+                        },
+                    },
+                },
+                'labels': {'Protein': {'value': 'dhfr'}},
+            }
+        }
+
+        def rendered_spec(field_name):
+            return {
+                'job': 'run-smina',
+                'version': '1.0.0',
+                'variables': {'dynamicFieldName': field_name},
+                'outputs': {'results': output_spec},
+            }
+
+        plan = _get_annotation_plan(rendered_spec('a'), output_spec)
+        # The plan is reused for other instances of the job...
+        self.assertIs(_get_annotation_plan(rendered_spec('b'), output_spec), plan)
+        # ...and the output spec is left untouched.
+        self.assertNotIn('service-execution', output_spec['annotation-properties'])
+
+        labels = [label.to_dict() for label in _create_labels(plan)]
+        self.assertEqual(labels[0]['label'], 'protein')
+        self.assertEqual(labels[0]['value'], 'dhfr')
+        self.assertIn('created', labels[0])
+
+        for field_name in ['a', 'b']:
+            job_rendered_spec = rendered_spec(field_name)
+            annotation = _create_service_execution(
+                job_rendered_spec, job_rendered_spec, 'testuser', plan
+            ).to_dict()
+            self.assertEqual(annotation['service_ref'], 'Not supplied')
+            self.assertEqual(
+                set(annotation['fields']), {'minimizedAffinity', field_name}
+            )
+
+        print('\nTest 13.1 ok')
+
+    def test_14_create_job_annotations_max_workers(self):
+        print('14.1 create_job_annotations max_workers')
+        proj_dir = 'test/output/api/14/'
+        if not os.path.isdir(proj_dir):
+            os.makedirs(proj_dir)
+
+        job_application_spec = {
+            'variables': {'prefix': 'smina', 'ligands': 'candidates.sdf'}
+        }
+        job_rendered_spec = {
+            'job': 'run-smina',
+            'version': '1.0.0',
+            'outputs': {
+                f'output{index}': {
+                    'creates': f'results{index}.sdf',
+                    'annotation-properties': {
+                        'fields-descriptor': {
+                            'origin': 'squonk2-job',
+                            'description': 'Run smina docking',
+                            'fields': {
+                                f'field{index}': {
+                                    'type': 'number',
+                                    'expression': '{{ prefix }}_' + str(index),
+                                }
+                            },
+                        },
+                        'derived-from': 'ligands',
+                    },
+                }
+                for index in range(6)
+            },
+        }
+
+        serial_files = create_job_annotations(
+            proj_dir, job_application_spec, job_rendered_spec, 'testuser', True
+        )
+        self.assertEqual(len(serial_files), 18)
+        parallel_files = create_job_annotations(
+            proj_dir,
+            job_application_spec,
+            job_rendered_spec,
+            'testuser',
+            True,
+            max_workers=4,
+        )
+        self.assertEqual(parallel_files, serial_files)
+        # The rendered specification is not modified.
+        self.assertIn('job', job_rendered_spec)
+        self.assertIn('annotation-properties', job_rendered_spec['outputs']['output0'])
+
+        with open(serial_files[0], 'rt', encoding='utf8') as meta_file:
+            annotation = json.load(meta_file)['annotations'][0]
+            self.assertEqual(list(annotation['fields']), ['smina_0'])
+            self.assertNotIn(
+                'annotation-properties',
+                annotation['service_parameters']['outputs']['output5'],
+            )
+
+        print('\nTest 14.1 ok')
+
+    def test_15_derived_metadata_cache(self):
+        print('15.1 derived metadata cache')
+        proj_dir = 'test/output/api/15/'
+        if not os.path.isdir(proj_dir):
+            os.makedirs(proj_dir)
+        clear_derived_metadata_cache()
+
+        metadata = Metadata('ligands', '0000-1515', 'A description', 'Tom')
+        meta_path = os.path.join(proj_dir, 'candidates.meta.json')
+        _write_file(meta_path, metadata.to_json().encode('utf8'))
+
+        metrics = get_derived_metadata_cache_metrics()
+        derived_metadata = _get_derived_metadata(proj_dir, 'Tom', 'candidates.sdf')
+        self.assertEqual(derived_metadata['dataset_id'], '0000-1515')
+        self.assertIs(
+            _get_derived_metadata(proj_dir, 'Tom', 'candidates.sdf'), derived_metadata
+        )
+        new_metrics = get_derived_metadata_cache_metrics()
+        self.assertEqual(new_metrics['reads'], metrics['reads'] + 1)
+        self.assertEqual(new_metrics['reads_avoided'], metrics['reads_avoided'] + 1)
+        self.assertEqual(new_metrics['files'], 1)
+
+        # A changed file is read again.
+        metadata.set_description('A new description')
+        _write_file(meta_path, metadata.to_json().encode('utf8'))
+        derived_metadata = _get_derived_metadata(proj_dir, 'Tom', 'candidates.sdf')
+        self.assertEqual(derived_metadata['description'], 'A new description')
+        self.assertEqual(
+            get_derived_metadata_cache_metrics()['reads'], new_metrics['reads'] + 1
+        )
+
+        print('\nTest 15.1 ok')
+
+    def test_16_create_job_annotations_async(self):
+        print('16.1 create_job_annotations_async')
+        proj_dir = 'test/output/api/16/'
+        if not os.path.isdir(proj_dir):
+            os.makedirs(proj_dir)
+
+        job_application_spec = {'variables': {'ligands': 'candidates.sdf'}}
+        job_rendered_spec = {
+            'job': 'run-smina',
+            'version': '1.0.0',
+            'outputs': {
+                f'output{index}': {
+                    'creates': f'results{index}.sdf',
+                    'annotation-properties': {
+                        'fields-descriptor': {
+                            'origin': 'squonk2-job',
+                            'description': 'Run smina docking',
+                            'fields': {f'field{index}': {'type': 'number'}},
+                        },
+                        'labels': {'Protein': {'value': 'dhfr'}},
+                        'derived-from': 'ligands',
+                    },
+                }
+                for index in range(4)
+            },
+        }
+
+        written_files = asyncio.run(
+            create_job_annotations_async(
+                proj_dir, job_application_spec, job_rendered_spec, 'testuser', True
+            )
+        )
+        self.assertEqual(
+            written_files,
+            create_job_annotations(
+                proj_dir, job_application_spec, job_rendered_spec, 'testuser', True
+            ),
+        )
+        with open(written_files[1], 'rt', encoding='utf8') as schema_file:
+            self.assertIn('field0', json.load(schema_file)['fields'])
+
+        async def cancel_job_annotations():
+            task = asyncio.create_task(
+                create_job_annotations_async(
+                    proj_dir, job_application_spec, job_rendered_spec, 'testuser'
+                )
+            )
+            await asyncio.sleep(0)
+            task.cancel()
+            await task
+
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(cancel_job_annotations())
+
+        print('\nTest 16.1 ok')
+
+    def test_17_create_job_annotations_batch(self):
+        print('17.1 create_job_annotations_batch')
+        proj_dir = 'test/output/api/17/'
+        if not os.path.isdir(proj_dir):
+            os.makedirs(proj_dir)
+
+        def job_instance(job, results):
+            job_rendered_spec = {
+                'job': job,
+                'version': '1.0.0',
+                'outputs': {
+                    'results': {
+                        'creates': results,
+                        'annotation-properties': {
+                            'fields-descriptor': {
+                                'origin': 'squonk2-job',
+                                'description': 'Run a job',
+                                'fields': {'score': {'type': 'number'}},
+                            },
+                            'derived-from': 'ligands',
+                        },
+                    }
+                },
+            }
+            return (
+                proj_dir,
+                {'variables': {'ligands': 'candidates.sdf'}},
+                job_rendered_spec,
+                'testuser',
+            )
+
+        bad_instance = job_instance('run-smina', 'bad.sdf')
+        bad_instance[1]['variables'] = {}
+        job_instances = [
+            job_instance('run-smina', 'smina1.sdf'),
+            job_instance('run-rdock', 'rdock.sdf'),
+            bad_instance,
+            job_instance('run-smina', 'smina2.sdf'),
+        ]
+
+        for max_workers in [None, 2]:
+            results = create_job_annotations_batch(
+                job_instances, max_workers=max_workers
+            )
+            self.assertEqual(
+                results[0],
+                (
+                    [proj_dir + 'smina1.meta.json', proj_dir + 'smina1.schema.json'],
+                    None,
+                ),
+            )
+            self.assertEqual(results[1][0][0], proj_dir + 'rdock.meta.json')
+            self.assertEqual(results[2], ([], "KeyError: 'ligands'"))
+            self.assertEqual(results[3][0][0], proj_dir + 'smina2.meta.json')
+
+        print('\nTest 17.1 ok')
+
     def test_20_smina_annotation_no_existing_metadata(self):
         print('20 smina annotation no existing metadata')
         proj_dir = 'test/output/api/20/'
@@ -684,6 +1125,23 @@ class DataTierTestCase(unittest.TestCase):
             self.assertEqual(len(results_metadata['annotations']), 1)
             self.assertEqual(len(results_metadata['labels']), 3)
 
+        # Compressed metadata files are detected when read and can be written.
+        with open(travelling_metadata_path, 'wb') as meta_file:
+            meta_file.write(Metadata(**travelling_metadata).to_json(codec='zlib'))
+        create_job_annotations(
+            proj_dir,
+            job_application_spec,
+            job_rendered_spec,
+            'testuser',
+            False,
+            metadata_codec='gzip',
+        )
+        with open(results_metadata_path, 'rb') as meta_file:
+            compressed_metadata = Metadata.from_json(meta_file.read())
+        self.assertEqual(compressed_metadata.get_dataset_name(), 'candidates-10.sdf')
+        self.assertEqual(len(compressed_metadata.to_dict()['annotations']), 1)
+        self.assertEqual(len(compressed_metadata.to_dict()['labels']), 3)
+
         print('\nTest 21 ok')
 
     def test_22_fragstein_annotation_no_existing_metadata(self):
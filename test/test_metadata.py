@@ -1,10 +1,17 @@
 import unittest
+import os
 import json
 from data_manager_metadata.metadata import (
     Metadata,
+    PropertyChangeAnnotation,
     LabelAnnotation,
     FieldsDescriptorAnnotation,
     ServiceExecutionAnnotation,
+    decode_metadata_json,
+    get_annotation_filename,
+    get_field_expression,
+    load_annotations_json,
+    render_field_expressions,
 )
 
 from data_manager_metadata.annotation_utils import est_schema_field_type
@@ -12,6 +19,7 @@ from data_manager_metadata.exceptions import (
     ANNOTATION_ERRORS,
     AnnotationValidationError,
 )
+import md_manage
 
 
 class MetadataTestCase(unittest.TestCase):
@@ -775,6 +783,369 @@ class MetadataTestCase(unittest.TestCase):
 
         print('\nTest 11 ok')
 
+    def test_12_compiled_fields_state(self):
+        print('\n12. Test compiled fields are maintained as annotations are added')
+        metadata = Metadata('Dataset 12', '0000-1212', '', 'Tom')
+        self.assertEqual(metadata.get_compiled_fields()['fields'], {})
+
+        input_fields = {
+            'smiles': {'type': 'string', 'description': 'smiles', 'required': True},
+            'uuid': {'type': 'string', 'description': 'uuid'},
+        }
+        metadata.add_annotation(
+            FieldsDescriptorAnnotation('Supplier 1', 'A description', input_fields)
+        )
+        self.assertEqual(metadata.get_json_schema()['required'], ['smiles'])
+
+        # Changing the returned fields must not change the compiled fields
+        compiled = metadata.get_compiled_fields()
+        compiled['fields']['smiles']['type'] = 'number'
+        self.assertEqual(
+            metadata.get_compiled_fields()['fields']['smiles']['type'], 'string'
+        )
+
+        # A later annotation changes a field
+        metadata.add_annotations(
+            {
+                'type': 'FieldsDescriptorAnnotation',
+                'origin': 'Supplier 2',
+                'description': '',
+                'fields': {'uuid': {'type': 'integer', 'required': True}},
+            }
+        )
+        schema = metadata.get_json_schema()
+        self.assertEqual(schema['fields']['uuid']['type'], 'integer')
+        self.assertEqual(schema['required'], ['smiles', 'uuid'])
+
+        # A change to an annotation already in the compiled fields
+        metadata.get_annotation(0).add_field(
+            field_name='inchi', prop_type='string', description='InChI'
+        )
+        self.assertEqual(
+            list(metadata.get_json_schema()['fields']), ['smiles', 'uuid', 'inchi']
+        )
+
+        # And the compiled fields are rebuilt when the metadata is reloaded
+        reload_metadata = Metadata(**metadata.to_dict())
+        self.assertEqual(
+            reload_metadata.get_compiled_fields()['fields'],
+            metadata.get_compiled_fields()['fields'],
+        )
+
+        print('\nTest 12 ok')
+
+    def test_13_label_types(self):
+        print('\n13. Test latest labels filtered by label type')
+        metadata = Metadata('Dataset 13', '0000-1313', '', 'Tom')
+        metadata.add_labels(
+            [
+                {'type': 'LabelAnnotation', 'label': 'plain1', 'value': 'v1'},
+                {'type': 'LabelAnnotation', 'label': '#hash1', 'value': 'v1'},
+                {'type': 'LabelAnnotation', 'label': '@address1', 'value': 'v1'},
+                {'type': 'LabelAnnotation', 'label': 'plain2', 'value': 'v1'},
+            ]
+        )
+        # Repeatedly patch a label
+        for count in range(50):
+            metadata.add_label(LabelAnnotation('plain1', f'v{count}'))
+        metadata.add_label(LabelAnnotation('#hash1', active=False))
+
+        self.assertEqual(len(metadata.get_labels()), 4)
+        self.assertEqual(
+            metadata.get_labels(active=True, labels_only=True),
+            {'plain1': 'v49', 'plain2': 'v1', '@address1': 'v1'},
+        )
+        self.assertEqual(
+            list(metadata.get_labels(labels_only=True, label_type='plain')),
+            ['plain1', 'plain2'],
+        )
+        self.assertEqual(len(metadata.get_labels(label_type='hash')), 1)
+        self.assertEqual(len(metadata.get_labels(True, label_type='hash')), 0)
+        self.assertEqual(
+            metadata.get_labels(True, True, label_type='address'), {'@address1': 'v1'}
+        )
+
+        print('\nTest 13 ok')
+
+    def test_14_labels_for_synchronisation(self):
+        print('\n14. Test labels selected for synchronisation')
+
+        def label_row(label, created, active=True):
+            return {
+                'type': 'LabelAnnotation',
+                'label': label,
+                'value': created[-2:],
+                'active': active,
+                'created': created,
+            }
+
+        sync_time = '2022-01-01T12:00:00.000000'
+        metadata = Metadata(
+            'Dataset 14',
+            '0000-1414',
+            '',
+            'Tom',
+            labels=[
+                label_row('plain1', '2021-06-01T12:00:00.000001'),
+                label_row('#hash1', '2021-06-01T12:00:00.000002'),
+                label_row('@address1', '2021-06-01T12:00:00.000003'),
+                label_row('plain2', '2021-06-01T12:00:00.000004'),
+                label_row('#hash2', '2021-06-01T12:00:00.000005', active=False),
+                # Labels applied by a job after the synchronisation
+                label_row('plain2', '2022-06-01T12:00:00.000006'),
+                label_row('plain3', '2022-06-01T12:00:00.000007'),
+                label_row('plain4', '2022-06-01T12:00:00.000008'),
+                label_row('plain4', '2022-06-01T12:00:00.000009', active=False),
+            ],
+        )
+
+        existing = metadata.get_labels_existing_dataset(sync_time)
+        self.assertEqual(
+            [(label['label'], label['value']) for label in existing],
+            [('plain2', '06'), ('plain3', '07'), ('plain4', '08'), ('plain4', '09')],
+        )
+
+        new = metadata.get_labels_new_dataset(sync_time)
+        self.assertEqual(
+            sorted((label['label'], label['value']) for label in new),
+            [('#hash1', '02'), ('@address1', '03'), ('plain2', '06'), ('plain3', '07')],
+        )
+
+        # A synchronised datetime without microseconds
+        self.assertEqual(
+            len(metadata.get_labels_existing_dataset('2030-01-01T00:00:00')), 0
+        )
+
+        print('\nTest 14 ok')
+
+    def test_15_trusted_load(self):
+        print('\n15. Test trusted load of metadata')
+        metadata_dict = json.loads(self.metadata.to_json())
+        self.assertTrue(metadata_dict['annotations'])
+        self.assertTrue(metadata_dict['labels'])
+        original_json = json.dumps(metadata_dict)
+
+        trusted_metadata = Metadata.from_dict(metadata_dict, trusted=True)
+        validated_metadata = Metadata.from_dict(metadata_dict)
+        self.assertEqual(trusted_metadata.to_json(), validated_metadata.to_json())
+        self.assertEqual(
+            trusted_metadata.get_json_schema(), validated_metadata.get_json_schema()
+        )
+        self.assertEqual(
+            trusted_metadata.get_compiled_fields()['fields'],
+            validated_metadata.get_compiled_fields()['fields'],
+        )
+        self.assertEqual(
+            trusted_metadata.get_labels(active=True),
+            validated_metadata.get_labels(active=True),
+        )
+        # The dictionary is not changed
+        self.assertEqual(json.dumps(metadata_dict), original_json)
+
+        # Trusted metadata is not re-validated but new labels are.
+        metadata_dict['labels'][0]['label'] = 'label1toolonganame'
+        trusted_metadata = Metadata.from_dict(metadata_dict, trusted=True)
+        self.assertIn(
+            'label1toolonganame', trusted_metadata.get_labels(labels_only=True)
+        )
+        with self.assertRaises(AnnotationValidationError):
+            Metadata.from_dict(metadata_dict)
+        with self.assertRaises(AnnotationValidationError):
+            trusted_metadata.add_labels(
+                [{'type': 'LabelAnnotation', 'label': 'label2toolonganame'}]
+            )
+
+        print('\nTest 15 ok')
+
+    def test_16_lazy_annotations(self):
+        print('\n16. Test trusted annotations are only created when used')
+        metadata = Metadata('Dataset 16', '0000-1616', '', 'Tom')
+        metadata.set_description('A description')
+        metadata.add_annotation(
+            FieldsDescriptorAnnotation(
+                'Supplier 1', '', {'smiles': {'type': 'string', 'required': True}}
+            )
+        )
+        metadata.add_annotation(
+            ServiceExecutionAnnotation(
+                'Jupyter notebook',
+                '1.0',
+                'User-1',
+                'service description',
+                'www.example.com/service.html',
+                {'param1': 'p-value1'},
+                fields={'uuid': {'type': 'string'}},
+            )
+        )
+        metadata_dict = json.loads(metadata.to_json())
+        annotation_types = [
+            'PropertyChangeAnnotation',
+            'FieldsDescriptorAnnotation',
+            'ServiceExecutionAnnotation',
+        ]
+
+        metadata = Metadata.from_dict(metadata_dict, trusted=True)
+        metadata.add_labels([{'type': 'LabelAnnotation', 'label': 'lazy'}])
+        self.assertEqual(
+            metadata.to_dict()['annotations'], metadata_dict['annotations']
+        )
+        self.assertEqual(
+            len(metadata.get_annotations_dict('ServiceExecutionAnnotation')), 1
+        )
+        # Laziness is only visible in the (private) annotation list
+        raw_annotations = metadata._annotations  # pylint: disable=protected-access
+        self.assertTrue(all(isinstance(anno, dict) for anno in raw_annotations))
+
+        # Compiling the fields does not create the fields annotations
+        self.assertEqual(metadata.get_json_schema()['required'], ['smiles'])
+        self.assertTrue(all(isinstance(anno, dict) for anno in raw_annotations))
+
+        # Annotations are created when they are accessed
+        self.assertEqual(
+            metadata.get_annotation(0).get_type(), 'PropertyChangeAnnotation'
+        )
+        self.assertEqual(
+            [anno.get_type() for anno in metadata.annotations], annotation_types
+        )
+        self.assertEqual(
+            metadata.get_annotations_json(), json.dumps(metadata_dict['annotations'])
+        )
+
+        print('\nTest 16 ok')
+
+    def test_17_cached_serialisation(self):
+        print('\n17. Test cached annotation serialisation')
+        metadata = Metadata('Dataset 17', '0000-1717', 'Déjà vu', 'Tom')
+        metadata.set_description('A "quoted" description')
+        annotation = FieldsDescriptorAnnotation(
+            'Supplier 1', '', {'smiles': {'type': 'string', 'required': True}}
+        )
+        metadata.add_annotation(annotation)
+        metadata.add_label(LabelAnnotation('label1', 'ünïcode'))
+        self.assertEqual(metadata.to_json(), json.dumps(metadata.to_dict()))
+        self.assertEqual(
+            Metadata.from_dict(metadata.to_dict(), trusted=True).to_json(),
+            metadata.to_json(),
+        )
+        empty_metadata = Metadata('Empty', '0000', '', 'Tom')
+        self.assertEqual(empty_metadata.to_json(), json.dumps(empty_metadata.to_dict()))
+
+        # Changing the returned dictionary does not change the annotation
+        annotation_dict = annotation.to_dict()
+        annotation_dict['origin'] = 'Changed'
+        self.assertEqual(annotation.to_dict()['origin'], 'Supplier 1')
+
+        # Changing the annotation updates the cached forms
+        annotation.add_field(field_name='uuid', prop_type='string')
+        annotation.set_origin('Supplier 2')
+        self.assertEqual(json.loads(annotation.to_json())['origin'], 'Supplier 2')
+        self.assertIn('uuid', annotation.to_dict()['fields'])
+
+        print('\nTest 17 ok')
+
+    def test_18_compact_annotations(self):
+        print('\n18. Test annotations are held compactly')
+        fields = {
+            'smiles': {
+                'type': 'string',
+                'description': 'standardized smiles',
+                'required': True,
+                'active': True,
+            }
+        }
+        annotations = [
+            PropertyChangeAnnotation('description', 'A description'),
+            LabelAnnotation('label1', 'value1'),
+            FieldsDescriptorAnnotation('Supplier 1', 'A description', fields),
+            ServiceExecutionAnnotation(
+                'Jupyter notebook',
+                '1.0',
+                'User-1',
+                'service description',
+                'www.example.com/service.html',
+                {'param1': 'p-value1'},
+                'Supplier 1',
+                'A description',
+                fields,
+            ),
+        ]
+        for annotation in annotations:
+            self.assertFalse(hasattr(annotation, '__dict__'))
+            reloaded = annotation.__class__.from_dict(annotation.to_dict())
+            self.assertEqual(reloaded.to_json(), annotation.to_json())
+            self.assertFalse(hasattr(reloaded, '__dict__'))
+
+        self.assertEqual(annotations[2].to_dict()['fields'], fields)
+        self.assertEqual(annotations[3].get_property('smiles'), fields['smiles'])
+
+        print('\nTest 18 ok')
+
+    def test_19_timestamps(self):
+        print('\n19. Test timestamps are serialised unchanged')
+        timestamps = [
+            '2021-06-01T10:15:20.123456',
+            '2021-06-01T10:15:20.000001',
+            '2021-06-01T10:15:20',
+            '1969-12-31T23:59:59.999999',
+            '2022-01-01T12:00:00+01:00',
+            '2021-06-01T10:15:20.123456+00:00',
+        ]
+        for timestamp in timestamps:
+            metadata = Metadata(
+                'test',
+                '54321',
+                'Dataset description',
+                'Bob',
+                created=timestamp,
+                last_updated=timestamp,
+                synchronised_datetime=timestamp,
+            )
+            metadata_dict = metadata.to_dict()
+            self.assertEqual(metadata_dict['created'], timestamp)
+            self.assertEqual(metadata_dict['last_updated'], timestamp)
+            self.assertEqual(metadata.get_synchronised_datetime(), timestamp)
+
+            label = LabelAnnotation('label1', 'value1')
+            label.set_created(timestamp)
+            self.assertEqual(label.to_dict()['created'], timestamp)
+            self.assertEqual(label.get_created(), timestamp)
+
+        # Labels are selected by comparing their created times.
+        metadata = Metadata('test', '54321', 'Dataset description', 'Bob')
+        metadata.add_labels(
+            [
+                {
+                    'type': 'LabelAnnotation',
+                    'label': 'label1',
+                    'value': 'value1',
+                    'created': '2021-06-01T10:15:20',
+                },
+                {
+                    'type': 'LabelAnnotation',
+                    'label': 'label2',
+                    'value': 'value2',
+                    'created': '2021-06-01T10:15:20.000001',
+                },
+                {
+                    'type': 'LabelAnnotation',
+                    'label': 'label3',
+                    'value': 'value3',
+                    'created': '2021-06-01T11:15:20+01:00',
+                },
+            ]
+        )
+        self.assertEqual(
+            [
+                label['label']
+                for label in metadata.get_labels_existing_dataset(
+                    '2021-06-01T10:15:20.000000'
+                )
+            ],
+            ['label2'],
+        )
+
+        print('\nTest 19 ok')
+
     def test_20_annotation_utilities(self):
         print('\n20. Tests for field types')
         self.assertEqual(est_schema_field_type('1'), 'integer')
@@ -788,8 +1159,376 @@ class MetadataTestCase(unittest.TestCase):
         self.assertEqual(est_schema_field_type('ID1234'), 'string')
         print('\nTest 20 ok')
 
+    def test_21_merge_annotations(self):
+        print('\n21. Test annotations are merged from other metadata')
+        version = Metadata('Dataset 21', '0000-2121', '', 'Tom', dataset_version=1)
+        version.set_description('A description')
+        version.add_annotation(
+            FieldsDescriptorAnnotation(
+                'Supplier 1', '', {'smiles': {'type': 'string', 'required': True}}
+            )
+        )
+        version_dict = json.loads(version.to_json())
+        dataset_dict = Metadata('Dataset 21', '0000-2121', '', 'Tom').to_dict()
+
+        expected = Metadata.from_dict(dataset_dict)
+        expected.add_annotations(version_dict['annotations'])
+
+        merged = Metadata.from_dict(dataset_dict, trusted=True)
+        merged.add_annotation(PropertyChangeAnnotation('description', 'Merged'))
+        merged.get_json_schema()
+        merged.merge_annotations(Metadata.from_dict(version_dict, trusted=True))
+        self.assertEqual(
+            merged.get_annotations_dict()[1:], expected.get_annotations_dict()
+        )
+        # The merged annotations are neither re-created nor copied.
+        self.assertIs(merged.get_annotations_dict()[1], version_dict['annotations'][0])
+        self.assertEqual(merged.get_json_schema()['required'], ['smiles'])
+
+        print('\nTest 21 ok')
+
+    def test_22_service_parameters_table(self):
+        print('\n22. Test service parameters are held once')
+        params = {'image': 'smina', 'variables': {'count': 1}}
+        metadata = Metadata('Dataset 22', '0000-2222', '', 'Tom')
+        for service_parameters in [params, dict(params), {'image': 'other'}]:
+            metadata.add_annotations(
+                ServiceExecutionAnnotation(
+                    'Jupyter notebook',
+                    '1.0',
+                    'User-1',
+                    'service description',
+                    'www.example.com/service.html',
+                    service_parameters,
+                ).to_dict()
+            )
+        annotations = metadata.annotations
+        self.assertIs(
+            annotations[0].get_service_parameters(),
+            annotations[1].get_service_parameters(),
+        )
+        # Nothing else holds the annotation's own copy of the parameters
+        for annotation in annotations:
+            self.assertIs(annotation.spec, annotation.get_service_parameters())
+        new_annotation = ServiceExecutionAnnotation(
+            'Jupyter notebook',
+            '1.0',
+            'User-1',
+            'service description',
+            'www.example.com/service.html',
+            params,
+        )
+        metadata.add_annotation(new_annotation)
+        self.assertIs(new_annotation.spec, annotations[0].get_service_parameters())
+        self.assertIs(
+            new_annotation.get_service_parameters(),
+            annotations[0].get_service_parameters(),
+        )
+
+        metadata_dict = metadata.to_dict()
+        self.assertNotIn('service_parameters_table', metadata_dict)
+        self.assertEqual(metadata_dict['annotations'][1]['service_parameters'], params)
+
+        compact_dict = metadata.to_dict(compact=True)
+        self.assertEqual(len(compact_dict['service_parameters_table']), 2)
+        self.assertNotIn('service_parameters', compact_dict['annotations'][0])
+        self.assertEqual(
+            compact_dict['annotations'][0]['service_parameters_ref'],
+            compact_dict['annotations'][1]['service_parameters_ref'],
+        )
+        self.assertEqual(json.loads(metadata.to_json(compact=True)), compact_dict)
+
+        # Compact metadata is expanded when it is loaded
+        for reloaded in [
+            Metadata(**compact_dict),
+            Metadata.from_dict(compact_dict, trusted=True),
+        ]:
+            self.assertEqual(reloaded.to_json(), metadata.to_json())
+            self.assertEqual(
+                reloaded.get_annotation(1).get_service_parameters(), params
+            )
+            self.assertEqual(reloaded.to_dict(compact=True), compact_dict)
+
+        print('\nTest 22 ok')
+
+    def test_23_compressed_json(self):
+        print('\n23. Test compressed metadata JSON')
+        metadata = Metadata('Dataset 23', '0000-2323', 'A description', 'Tom')
+        metadata.add_labels([{'type': 'LabelAnnotation', 'label': 'label1'}])
+        metadata.add_annotation(
+            FieldsDescriptorAnnotation('Supplier 1', '', {'smiles': {'type': 'string'}})
+        )
+        metadata_json = metadata.to_json()
+
+        for codec in ['zlib', 'gzip']:
+            compressed = metadata.to_json(codec=codec)
+            self.assertIsInstance(compressed, bytes)
+            self.assertEqual(decode_metadata_json(compressed), metadata_json)
+            self.assertEqual(Metadata.from_json(compressed).to_json(), metadata_json)
+            self.assertEqual(
+                Metadata.from_json(compressed, trusted=True).to_json(), metadata_json
+            )
+        self.assertEqual(
+            decode_metadata_json(metadata.to_json(compact=True, codec='zlib')),
+            metadata.to_json(compact=True),
+        )
+
+        # Uncompressed JSON (text or bytes) is also accepted
+        self.assertEqual(Metadata.from_json(metadata_json).to_json(), metadata_json)
+        self.assertEqual(
+            Metadata.from_json(metadata_json.encode('utf8')).to_json(), metadata_json
+        )
+
+        with self.assertRaises(ValueError):
+            metadata.to_json(codec='lzma')
+        with self.assertRaises(ValueError):
+            decode_metadata_json(b'DMM\x01\x09' + b'payload')
+        with self.assertRaises(ValueError):
+            decode_metadata_json(b'DMM\x01')
+
+        print('\nTest 23 ok')
+
+    def test_24_content_hash(self):
+        print('\n24. Test canonical JSON and content hash')
+        metadata = Metadata('Dataset 24', '0000-2424', 'A description', 'Tom')
+        metadata.add_labels([{'type': 'LabelAnnotation', 'label': 'label1'}])
+        metadata.add_annotation(
+            FieldsDescriptorAnnotation('Supplier 1', '', {'smiles': {'type': 'string'}})
+        )
+        canonical_json = metadata.to_canonical_json()
+        self.assertEqual(json.loads(canonical_json), metadata.to_dict())
+        self.assertEqual(
+            canonical_json,
+            json.dumps(metadata.to_dict(), sort_keys=True, separators=(',', ':')),
+        )
+
+        # Equal metadata has the same hash however it was loaded
+        content_hash = metadata.get_content_hash()
+        metadata_dict = json.loads(metadata.to_json())
+        for reloaded in [
+            Metadata(**metadata_dict),
+            Metadata.from_dict(metadata_dict, trusted=True),
+            Metadata.from_dict(metadata.to_dict(compact=True), trusted=True),
+        ]:
+            self.assertEqual(reloaded.get_content_hash(), content_hash)
+
+        # The hash follows changes to the metadata
+        metadata.add_label(LabelAnnotation('label2', 'value2'))
+        label_hash = metadata.get_content_hash()
+        self.assertNotEqual(label_hash, content_hash)
+        metadata.set_description('A new description')
+        self.assertNotEqual(metadata.get_content_hash(), label_hash)
+        self.assertEqual(
+            metadata.get_content_hash(),
+            Metadata(**json.loads(metadata.to_json())).get_content_hash(),
+        )
+
+        print('\nTest 24 ok')
+
+    def test_25_field_expressions(self):
+        print('\n25. Test compiled field expressions')
+        expression = get_field_expression('{{ prefix }}_score')
+        hits = get_field_expression.cache_info().hits
+        self.assertIs(get_field_expression('{{ prefix }}_score'), expression)
+        self.assertEqual(get_field_expression.cache_info().hits, hits + 1)
+
+        rendered = render_field_expressions(
+            {'score': expression, 'other': '{{ missing }}', 'bad': '{{ prefix'},
+            {'prefix': 'smina'},
+        )
+        self.assertEqual(rendered['score'], ('smina_score', True))
+        self.assertEqual(
+            rendered['other'],
+            (
+                'Undefined template variables for field-expression: missing',
+                False,
+            ),
+        )
+        self.assertFalse(rendered['bad'][1])
+        self.assertTrue(
+            rendered['bad'][0].startswith('TemplateSyntaxError with field-expression:')
+        )
+
+        # Fields whose expressions cannot be rendered are not added
+        annotation = FieldsDescriptorAnnotation(
+            'Supplier 25',
+            '',
+            {
+                'score': {'type': 'number', 'expression': '{{ prefix }}_score'},
+                'other': {'type': 'string', 'expression': '{{ missing }}'},
+                'smiles': {'type': 'string'},
+            },
+            {'variables': {'prefix': 'smina'}},
+        )
+        self.assertEqual(list(annotation.get_fields()), ['smina_score', 'smiles'])
+
+        print('\nTest 25 ok')
+
+    def test_26_annotations_json_lines(self):
+        print('\n26. Test annotations in JSON and JSON Lines')
+        annotations = [
+            FieldsDescriptorAnnotation(
+                'Supplier 26', '', {'smiles': {'type': 'string'}}
+            ).to_dict(),
+            PropertyChangeAnnotation('description', 'Old description').to_dict(),
+        ]
+        json_lines = ''.join(
+            json.dumps(annotation) + '\n' for annotation in annotations
+        )
+        self.assertEqual(load_annotations_json(json.dumps(annotations)), annotations)
+        self.assertEqual(
+            load_annotations_json(json.dumps(annotations[0])), annotations[:1]
+        )
+        self.assertEqual(load_annotations_json(json_lines), annotations)
+        self.assertEqual(load_annotations_json(json_lines + '\n'), annotations)
+        self.assertEqual(load_annotations_json(''), [])
+
+        metadata = Metadata('Dataset 26', '0000-2626', '', 'Tom')
+        metadata.add_annotations(json_lines)
+        self.assertEqual(metadata.get_annotations_dict(), annotations)
+        metadata.add_annotations(json.dumps(annotations))
+        self.assertEqual(len(metadata.get_annotations_dict()), 4)
+
+        print('\nTest 26 ok')
+
+    def test_27_trusted_annotations_serialisation(self):
+        print('\n27. Test trusted annotations serialise as created annotations')
+        metadata = Metadata('Dataset 27', '0000-2727', '', 'Tom')
+        metadata.add_annotation(
+            FieldsDescriptorAnnotation(
+                'Supplier 27', '', {'smiles': {'type': 'string'}}
+            )
+        )
+        metadata.add_annotation(PropertyChangeAnnotation('description', 'Old'))
+        stored = json.loads(metadata.to_json())
+        # Annotations stored by an earlier version (and another writer)
+        stored['annotations'][0]['annotation_version'] = '0.0.0'
+        stored['annotations'][1]['created'] = '2022-01-01T12:00:00+01:00'
+
+        validated = Metadata.from_dict(stored).to_dict()
+        self.assertEqual(
+            [anno['annotation_version'] for anno in validated['annotations']],
+            ['0.0.1', '0.0.1'],
+        )
+        self.assertEqual(
+            validated['annotations'][1]['created'], '2022-01-01T12:00:00+01:00'
+        )
+        trusted = Metadata.from_dict(stored, trusted=True)
+        self.assertEqual(trusted.to_dict(), validated)
+        self.assertEqual(json.loads(trusted.to_json()), validated)
+        self.assertEqual(len(trusted.annotations), 2)
+        self.assertEqual(trusted.to_dict(), validated)
+        # The stored dictionary is not changed
+        self.assertEqual(stored['annotations'][0]['annotation_version'], '0.0.0')
+
+        print('\nTest 27 ok')
+
+    def test_28_content_hash_loads(self):
+        print('\n28. Test the content hash of trusted and validated loads')
+        metadata = Metadata('Dataset 28', '0000-2828', '', 'Tom')
+        metadata.add_label(LabelAnnotation('label28', 'value28'))
+        metadata.add_annotation(
+            FieldsDescriptorAnnotation(
+                'Supplier 28', '', {'smiles': {'type': 'string'}}
+            )
+        )
+        stored = json.loads(metadata.to_json())
+        stored['annotations'][0]['annotation_version'] = '0.0.0'
+        stored['labels'][0]['annotation_version'] = '0.0.0'
+
+        trusted = Metadata.from_dict(stored, trusted=True)
+        content_hash = trusted.get_content_hash()
+        # The same object once its annotations have been created
+        self.assertEqual(len(trusted.annotations), 1)
+        self.assertEqual(trusted.get_content_hash(), content_hash)
+        # A trusted load that is created before it is hashed
+        hydrated = Metadata.from_dict(stored, trusted=True)
+        self.assertEqual(len(hydrated.annotations), 1)
+        self.assertEqual(hydrated.get_content_hash(), content_hash)
+        self.assertEqual(Metadata.from_dict(stored).get_content_hash(), content_hash)
+        self.assertEqual(Metadata(**trusted.to_dict()).get_content_hash(), content_hash)
+
+        print('\nTest 28 ok')
+
     def test_30_md_manage(self):
-        print('\n30. Tests for md_manage.py to be added')
+        print('\n30. Tests for md_manage.py')
+        out_dir = 'test/output/md_manage/'
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        anno_file = os.path.join(out_dir, get_annotation_filename('results.sdf'))
+        label = LabelAnnotation('label30', 'value30')
+        # An existing file in the original (JSON list) form
+        with open(anno_file, 'wt', encoding='utf8') as out_file:
+            json.dump([label.to_dict()], out_file)
+
+        annotation = FieldsDescriptorAnnotation(
+            'Supplier 30', '', {'smiles': {'type': 'string'}}
+        )
+        md_manage.append_annotation(anno_file, annotation)
+        md_manage.append_annotation(anno_file, LabelAnnotation('label31'))
+        with open(anno_file, 'rt', encoding='utf8') as in_file:
+            lines = in_file.readlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(json.loads(lines[1]), annotation.to_dict())
+
+        self.assertEqual(md_manage.compact_annotations(anno_file), 3)
+        with open(anno_file, 'rt', encoding='utf8') as in_file:
+            self.assertEqual(in_file.readlines(), lines)
+        self.assertEqual(md_manage.compact_annotations(anno_file, json_list=True), 3)
+        with open(anno_file, 'rt', encoding='utf8') as in_file:
+            self.assertEqual(json.load(in_file), [json.loads(line) for line in lines])
+
+        # An existing file holding a single annotation (over several lines)
+        with open(anno_file, 'wt', encoding='utf8') as out_file:
+            json.dump(label.to_dict(), out_file, indent=2)
+        md_manage.append_annotation(anno_file, annotation)
+        with open(anno_file, 'rt', encoding='utf8') as in_file:
+            self.assertEqual(
+                load_annotations_json(in_file.read()),
+                [label.to_dict(), annotation.to_dict()],
+            )
+
+        # An existing JSON Lines file without a newline after the last annotation
+        with open(anno_file, 'wt', encoding='utf8') as out_file:
+            out_file.write(json.dumps(label.to_dict()))
+        md_manage.append_annotation(anno_file, annotation)
+        with open(anno_file, 'rt', encoding='utf8') as in_file:
+            lines = in_file.readlines()
+        self.assertEqual(
+            [json.loads(line) for line in lines],
+            [label.to_dict(), annotation.to_dict()],
+        )
+
+        print('\nTest 30 ok')
+
+    def test_31_content_hash_changed_annotation(self):
+        print('\n31. Test the content hash follows changes to hashed annotations')
+        metadata = Metadata('Dataset 31', '0000-3131', '', 'Tom')
+        fields_descriptor = FieldsDescriptorAnnotation(
+            'Supplier 31', '', {'smiles': {'type': 'string'}}
+        )
+        metadata.add_annotation(fields_descriptor)
+        metadata.add_annotation(PropertyChangeAnnotation('description', ''))
+        metadata.add_labels([{'type': 'LabelAnnotation', 'label': 'label31'}])
+        content_hash = metadata.get_content_hash()
+
+        fields_descriptor.add_field(
+            field_name='inchi', prop_type='string', description='InChI'
+        )
+        changed_hash = metadata.get_content_hash()
+        self.assertNotEqual(changed_hash, content_hash)
+        self.assertEqual(
+            changed_hash, Metadata.from_dict(metadata.to_dict()).get_content_hash()
+        )
+
+        metadata.labels[0].set_created('2022-01-01T12:00:00')
+        self.assertNotEqual(metadata.get_content_hash(), changed_hash)
+        self.assertEqual(
+            metadata.get_content_hash(),
+            Metadata.from_dict(metadata.to_dict()).get_content_hash(),
+        )
+
+        print('\nTest 31 ok')
 
 
 if __name__ == '__main__':